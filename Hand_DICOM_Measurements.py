@@ -6,15 +6,25 @@ import os
 import pydicom
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
 import ctypes
 import math
 import numpy as np
-import pickle
+import working_file
+import measurement_export
+import image_export
+import dicom_header_cache
+import rater_comparison
+import reliability
+import measurement_store
+import geometry
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from multiprocessing import shared_memory
+from pydicom.pixels import iter_pixels, pixel_array
 
 
 ### Aug 29 ###
@@ -34,6 +44,287 @@ try:
 except Exception:
     pass
 
+
+# Runs in a worker process: decode some frames of a compressed DICOM straight into the shared frame buffer
+def decode_frames_into_shared(dicom_path, shm_name, shape, dtype, indices):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        buffer = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for index, frame in zip(indices, iter_pixels(dicom_path, indices=indices)):  # only these frames are read
+            buffer[index] = frame
+        del buffer
+    finally:
+        shm.close()
+    return indices
+
+
+# Average blocks of factor x factor pixels (trailing rows/columns that don't fill a block are dropped)
+def area_average(image, factor):
+    if factor <= 1:
+        return image
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    if height == 0 or width == 0:
+        return image
+    blocks = image[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    if image.dtype.kind in 'iu':
+        return (blocks.sum(axis=(1, 3), dtype=np.int64) // (factor * factor)).astype(image.dtype)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+
+# Decodes frames of a DICOM one at a time, only when they are asked for.
+# The most recently used frames are kept in an LRU cache so scrolling back and forth is instant,
+# while a 1000 frame study costs the same to open as a 10 frame one.
+# Each frame also gets a lazily built pyramid (level 1 = 1/2 size, level 2 = 1/4 ...) for zoomed out views,
+# stored in the same cache so frames and pyramid levels share one memory cap.
+class FrameProvider:
+    def __init__(self, data_set, max_cache_mb=256):
+        self.data_set = data_set
+        self.num_frames = int(getattr(data_set, 'NumberOfFrames', 1) or 1)
+        self.frame_shape = (int(data_set.Rows), int(data_set.Columns))   # (height, width)
+        self.max_cache_bytes = max_cache_mb * 1024 * 1024
+        self.cache_bytes = 0
+        self.cache = OrderedDict()                                          # {(frame_index, level): 2D array}
+        self.decoding = {}                                                  # {(frame_index, level): Event} decodes in progress
+        self.lock = threading.RLock()                                       # shared with the prefetch thread
+        self.volume = self.map_pixel_data()                                 # np.memmap for uncompressed files, else None
+
+        # Parallel decode of compressed files (see start_parallel_decode)
+        self.shared_buffer = None                                           # SharedMemory holding every decoded frame
+        self.shared_frames = None                                           # numpy view of shared_buffer
+        self.ready = set()                                                  # frame indices finished by the workers
+        self.executor = None
+
+    def __len__(self):
+        return self.num_frames
+
+    def get(self, index):
+        return self.get_level(index, 0)
+
+    def get_level(self, index, level):
+        if level == 0 and self.volume is not None:
+            return self.decode(index)                                       # memory-mapped view, nothing to cache
+
+        # The lock only guards the cache itself; decoding runs outside it so the prefetch thread and the
+        # viewer don't wait on each other's frames. A frame being decoded has an event in self.decoding,
+        # anyone else asking for it waits for that decode instead of starting a second one.
+        key = (index, level)
+        while True:
+            with self.lock:
+                if level == 0 and index in self.ready:
+                    return self.shared_frames[index]                        # already decoded by a worker process
+                if key in self.cache:
+                    self.cache.move_to_end(key)                             # mark as most recently used
+                    return self.cache[key]
+                decoding = self.decoding.get(key)
+                if decoding is None:
+                    decoding = self.decoding[key] = threading.Event()
+                    break
+            decoding.wait()                                                 # then look again (decode may have failed)
+
+        try:
+            if level == 0:
+                image = self.decode(index)
+            else:
+                image = area_average(self.get_level(index, level - 1), 2)
+            with self.lock:
+                self.cache[key] = image
+                self.cache_bytes += image.nbytes
+                while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+                    _, evicted = self.cache.popitem(last=False)             # evict least recently used
+                    self.cache_bytes -= evicted.nbytes
+            return image
+        finally:
+            with self.lock:
+                del self.decoding[key]
+            decoding.set()
+
+    def pyramid_level(self, factor):
+        # Coarsest level that still has at least one image pixel per screen pixel when factor image pixels
+        # fall on one screen pixel at full resolution
+        level = 0
+        while factor >= 2 ** (level + 1) and min(self.frame_shape) >= 2 ** (level + 1):
+            level += 1
+        return level
+
+    def decode(self, index):
+        if not 0 <= index < self.num_frames:
+            raise IndexError(f"Frame {index} out of range (0 - {self.num_frames - 1})")
+        if self.volume is not None:
+            return self.volume[index]
+        return pixel_array(self.data_set, index=index)
+
+    def map_pixel_data(self):
+        # Map uncompressed pixel data straight from the file (zero-copy), only the pages viewed are read.
+        # Returns None when the data has to go through the pydicom decoders instead.
+        ds = self.data_set
+        filename = getattr(ds, 'filename', None)
+        transfer_syntax = getattr(getattr(ds, 'file_meta', None), 'TransferSyntaxUID', None)
+        if not isinstance(filename, str) or transfer_syntax is None or transfer_syntax.is_encapsulated:
+            return None
+
+        bits_allocated = int(getattr(ds, 'BitsAllocated', 0))
+        bits_stored = int(getattr(ds, 'BitsStored', bits_allocated))
+        signed = int(getattr(ds, 'PixelRepresentation', 0)) == 1
+        if bits_allocated not in (8, 16, 32) or int(getattr(ds, 'SamplesPerPixel', 1)) != 1:
+            return None
+        if bits_stored != bits_allocated:
+            return None                                                     # high bits need masking / sign extension, let pydicom do it
+
+        element = ds.get_item(0x7FE00010, keep_deferred=True)               # raw PixelData element, holds its file offset
+        offset = getattr(element, 'value_tell', None)
+        if offset is None:
+            return None
+
+        rows, cols = self.frame_shape
+        byte_order = '<' if transfer_syntax.is_little_endian else '>'
+        dtype = np.dtype(f"{byte_order}{'i' if signed else 'u'}{bits_allocated // 8}")
+        if element.length < self.num_frames * rows * cols * dtype.itemsize:
+            return None
+
+        try:
+            return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(self.num_frames, rows, cols))
+        except (OSError, ValueError):
+            return None
+
+    def is_compressed(self):
+        transfer_syntax = getattr(getattr(self.data_set, 'file_meta', None), 'TransferSyntaxUID', None)
+        return transfer_syntax is not None and transfer_syntax.is_encapsulated
+
+    def start_parallel_decode(self, workers=None):
+        # Decode every frame of a compressed file across a process pool into one shared-memory buffer.
+        # Frames become available through get() as soon as their chunk is done.
+        filename = getattr(self.data_set, 'filename', None)
+        if self.volume is not None or not self.is_compressed() or not isinstance(filename, str) or self.num_frames < 2:
+            return False
+
+        first = self.get(0)                                                 # gives the decoded dtype and shape
+        shape = (self.num_frames,) + first.shape
+        nbytes = int(np.prod(shape)) * first.dtype.itemsize
+        self.shared_buffer = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shared_frames = np.ndarray(shape, dtype=first.dtype, buffer=self.shared_buffer.buf)
+        self.shared_frames[0] = first
+        self.ready.add(0)
+
+        workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        chunk = max(1, (self.num_frames - 1) // (workers * 4))              # several chunks per worker balances the load
+        remaining = list(range(1, self.num_frames))
+        for start in range(0, len(remaining), chunk):
+            indices = remaining[start:start + chunk]
+            future = self.executor.submit(decode_frames_into_shared, filename, self.shared_buffer.name,
+                                          shape, first.dtype.str, indices)
+            future.add_done_callback(self.on_chunk_decoded)
+        return True
+
+    def on_chunk_decoded(self, future):
+        if future.cancelled():
+            return
+        try:
+            indices = future.result()
+        except Exception as e:
+            print(f"Parallel decode failed for some frames, decoding them on demand instead: {e}")
+            return
+        with self.lock:
+            if self.shared_frames is not None:
+                self.ready.update(indices)
+
+    def close(self):
+        # Stop any background decoding and release the shared frame buffer
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        with self.lock:
+            self.ready.clear()
+            self.cache.clear()
+            self.cache_bytes = 0
+            self.shared_frames = None
+            if self.shared_buffer is not None:
+                self.shared_buffer.unlink()
+                try:
+                    self.shared_buffer.close()
+                except BufferError:
+                    pass                                                    # a frame view is still in use, freed once it is dropped
+                self.shared_buffer = None
+
+    def sample_range(self):
+        # Estimate (min, max) from the first, middle and last frames instead of decoding the whole volume
+        indices = sorted({0, self.num_frames // 2, self.num_frames - 1})
+        frames = [self.get(i) for i in indices]
+        return int(min(f.min() for f in frames)), int(max(f.max() for f in frames))
+
+
+# Worker thread that decodes and window-levels the next few frames in the scroll direction,
+# so navigating with the wheel/slider/arrow keys finds the frame already prepared.
+# When zoomed out it builds the pyramid level being displayed instead.
+class FramePrefetcher:
+    def __init__(self, frames, window_func, depth=4):
+        self.frames = frames                    # FrameProvider
+        self.window_func = window_func          # window_func(frame, wc, ww) -> uint8 frame
+        self.depth = depth                      # number of frames to prepare ahead
+        self.cache_size = 2 * depth + 8
+        self.cache = OrderedDict()              # {(frame_index, wc, ww): windowed frame}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.target = None                      # (frame_index, direction, wc, ww, level) of the latest request
+        self.cancelled = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get(self, index, wc, ww):
+        with self.lock:
+            frame = self.cache.get((index, wc, ww))
+            if frame is not None:
+                self.cache.move_to_end((index, wc, ww))
+            return frame
+
+    def put(self, index, wc, ww, frame):
+        with self.lock:
+            self.cache[(index, wc, ww)] = frame
+            self.cache.move_to_end((index, wc, ww))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def request(self, index, direction, wc, ww, level=0):
+        # Newer requests replace older ones, the worker always follows the latest position
+        with self.wakeup:
+            self.target = (index, direction, wc, ww, level)
+            self.wakeup.notify()
+
+    def cancel(self):
+        with self.wakeup:
+            self.cancelled = True
+            self.cache.clear()
+            self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                while self.target is None and not self.cancelled:
+                    self.wakeup.wait()
+                if self.cancelled:
+                    return
+                index, direction, wc, ww, level = self.target
+                self.target = None
+
+            for step in range(1, self.depth + 1):
+                i = index + step * direction
+                if not 0 <= i < self.frames.num_frames:
+                    break
+                with self.lock:
+                    if self.cancelled or self.target is not None:
+                        break                   # file changed or user moved on, start over from the new position
+                    if level == 0 and (i, wc, ww) in self.cache:
+                        continue
+                try:
+                    if level == 0:
+                        self.put(i, wc, ww, self.window_func(self.frames.get(i), wc, ww))
+                    else:
+                        self.frames.get_level(i, level)     # kept in the frame cache
+                except Exception as e:
+                    print(f"Prefetch of frame {i + 1} failed: {e}")
+                    break
+
+
 class DICOMViewer:
     def __init__(self, root):
 
@@ -41,20 +332,37 @@ class DICOMViewer:
         self.root = root
         self.root.title("Hand DICOM Viewer with Measurements")
         self.current_working_file = None  # Store path of the loaded .dcmstate file
+        self.journal = None             # SessionJournal: append-only autosave next to the DICOM
+        self.save_executor = ThreadPoolExecutor(max_workers=1)  # one writer thread, saves finish in order
+        self.header_cache = dicom_header_cache.HeaderCache()    # spacing/geometry of DICOMs seen before
         self.frame_index = 0
         self.num_frames = 1
         self.dicom = None
-        self.pixel_data = None
+        self.frames = None              # FrameProvider: decodes frames on demand
+        self.prefetcher = None          # FramePrefetcher: prepares upcoming frames in the background
+        self.prefetch_depth = 4         # how many frames ahead to prepare while scrolling
+        self.parallel_decode_var = tk.BooleanVar(value=False)   # decode compressed studies across all CPU cores
+        self.scroll_direction = 1       # +1 forward, -1 backward (predicted from the last move)
+        self.last_shown_index = None
+        self.image_artist = None        # AxesImage reused across redraws (see create_artists)
+        self.image_key = None           # (frame_index, wc, ww) currently shown by image_artist
+        self.overlay_artists = {}       # persistent Line2D artists for bone line, h, H and click preview
+        self.blit_background = None     # cached render without overlays while dragging (see start_blit)
+        self.window_luts = {}           # {(dtype, wc, ww): uint8 lookup table} (see get_window_lut)
         self.pixel_spacing = [1.0, 1.0]
         self.resize_after_id = None
+        self.render_after_id = None     # pending scheduled redraw (see request_render)
+        self.render_interval = 16       # ms, at most one scheduled redraw per display frame
 
         # Measurement tools
-        self.measurements = {}          # dicts: {frame_index: {'h': (p1, p2), 'H': (p1, p2)}, ...}
+        self.store = measurement_store.MeasurementStore()   # one array record per frame, seen through the dicts below
+        self.measurements = self.store.measurements         # {frame_index: {'h': (p1, p2), 'H': (p1, p2)}, ...}
         self.points = []                # list: storage for clicked points eg., [(x1, y1), (x2, y2)]
         self.selected_point = None
         self.dragging = False
-        self.bone_lines = {}            # dict: {frame_index: (p1, p2)}     - dashed cyan line
-        self.bone_slope = {}            # dict: {frame_index: float}        - slope value of bone line
+        self.bone_lines = self.store.bone_lines             # {frame_index: (p1, p2)}     - dashed cyan line
+        self.bone_slope = self.store.bone_slope             # {frame_index: float}        - slope value of bone line
+        self.overlay_cache = {}         # {frame_index: (store revision, drawn h/H segments)}, see overlay_geometry
         self.hx2_Hx1 = None             # float: temporary storage of x2 for H measurement alignment with h
         self.measure_step = None
 
@@ -98,6 +406,7 @@ class DICOMViewer:
         self.filename_label = tk.Label(file_frame, text="No file loaded", anchor='w')         # File name
         self.filename_label.pack(side=tk.LEFT, padx=(2, 8))
         tk.Button(file_frame, text="Load DICOM File", command=self.load_file).pack(side=tk.RIGHT)   # Load file button
+        tk.Checkbutton(self.control_frame, text="Parallel decode (compressed files)", variable=self.parallel_decode_var).pack(anchor='w')
 
         # Save working file
         save_frame = tk.Frame(self.control_frame)
@@ -225,6 +534,9 @@ class DICOMViewer:
         self.canvas.get_tk_widget().bind("<Button-4>", self.on_mouse_wheel)        # Linux scroll up
         self.canvas.get_tk_widget().bind("<Button-5>", self.on_mouse_wheel)        # Linux scroll down
 
+        # Flush the autosave journal and stop background work when the window is closed
+        self.root.protocol("WM_DELETE_WINDOW", self.on_app_close)
+
         # Set focus to the canvas to stay responsive to keyboard events
         self.root.after(100, self.set_initial_focus)
         self.canvas.mpl_connect("button_press_event", lambda event: self.canvas.get_tk_widget().focus_set())
@@ -241,21 +553,19 @@ class DICOMViewer:
         if not filepath:
             return
         try:
-            data_set = pydicom.dcmread(filepath)
-            if not hasattr(data_set, 'pixel_array'):
+            data_set = pydicom.dcmread(filepath, defer_size='1 MB')     # leave pixel data on disk until needed
+            if 'PixelData' not in data_set:
                 print("DICOM has no pixel data.")
                 return
 
             self.dicom = data_set
-            self.pixel_data = data_set.pixel_array
-            self.num_frames = self.pixel_data.shape[0] if self.pixel_data.ndim == 3 else 1
+            self.set_frames(data_set)
             # typically Row=0.06246 mm, Col=0.06246 mm
             self.pixel_spacing = [float(sp) for sp in data_set.PixelSpacing] if hasattr(data_set, 'PixelSpacing') else [1.0, 1.0]
+            self.header_cache.remember(filepath, data_set)
 
             self.frame_index = 0
-            self.measurements.clear()
-            self.bone_lines.clear()
-            self.bone_slope.clear()
+            self.store.reset(self.num_frames)
             self.points.clear()
             self.selected_point = None
             self.dragging = False
@@ -266,6 +576,7 @@ class DICOMViewer:
             self.slider.set(1)
             self.initialize_window_level_from_pixel_data()
             self.current_working_file = None  # Clear any working file info
+            self.start_journal(filepath)
 
             filename = os.path.basename(filepath)
             self.filename_label.config(text=f"File: {filename}")
@@ -275,31 +586,162 @@ class DICOMViewer:
             print(f"Error loading DICOM: {e}")
         self.focus_app_window()
 
+    def set_frames(self, data_set):
+        # Swap in a new frame source; any prefetching for the previous file is cancelled
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        if self.frames is not None:
+            self.frames.close()
+        self.frames = FrameProvider(data_set)
+        self.num_frames = self.frames.num_frames
+        if self.parallel_decode_var.get():
+            self.frames.start_parallel_decode()
+        self.prefetcher = FramePrefetcher(self.frames, self.apply_window_level, depth=self.prefetch_depth)
+        self.scroll_direction = 1
+        self.last_shown_index = None
+        self.image_key = None
+
+    def get_windowed_frame(self, index):
+        wc, ww = self.window_center, self.window_width
+        frame = self.prefetcher.get(index, wc, ww)
+        if frame is None:
+            frame = self.apply_window_level(self.frames.get(index), wc, ww)
+            self.prefetcher.put(index, wc, ww, frame)
+        return frame
+
+    def prefetch_ahead(self, index, level):
+        # Predict the scroll direction from the last move and prepare the frames ahead
+        if self.last_shown_index is not None and index != self.last_shown_index:
+            self.scroll_direction = 1 if index > self.last_shown_index else -1
+        self.last_shown_index = index
+        self.prefetcher.request(index, self.scroll_direction, self.window_center, self.window_width, level)
+
+    def create_artists(self):
+        # Build the image and overlay artists once; later redraws only update their data
+        self.ax.clear()
+        self.ax.axis('off')
+        self.figure.subplots_adjust(left=0, right=1, top=1, bottom=0) # remove padding around the image
+
+        dot = 'o'
+        dotsize = 0.5
+        linesize = 0.8
+
+        # Placeholder image, show_frame fills in the data and extent
+        img_height, img_width = self.frames.frame_shape
+        self.image_artist = self.ax.imshow(np.zeros((1, 1), dtype=np.uint8), cmap='gray', aspect='equal',
+                                           vmin=0, vmax=255, extent=[0, img_width, img_height, 0])
+        self.image_key = None
+        self.overlay_artists = {
+            'h': self.ax.plot([], [], color='red', linewidth=linesize)[0],
+            'h_ends': self.ax.plot([], [], color='red', marker=dot, markersize=dotsize, linestyle='None')[0],
+            'H': self.ax.plot([], [], color='yellow', linewidth=linesize)[0],
+            'H_ends': self.ax.plot([], [], color='yellow', marker=dot, markersize=dotsize, linestyle='None')[0],
+            'bone': self.ax.plot([], [], linestyle='dashed', linewidth=linesize, color='cyan', alpha=0.4)[0],  # 0 < alpha < 1
+            'bone_ends': self.ax.plot([], [], color='cyan', marker=dot, markersize=dotsize, linestyle='None')[0],
+            'preview': self.ax.plot([], [], linestyle='dashed', linewidth=linesize, color='cyan')[0],
+            'preview_ends': self.ax.plot([], [], color='cyan', marker=dot, markersize=dotsize, linestyle='None')[0],
+        }
+
+    def set_overlay(self, name, points, with_line=True):
+        # Show the line (and its endpoint markers) through points, or hide both if there are none
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        if with_line:
+            self.overlay_artists[name].set_data(xs, ys)
+            self.overlay_artists[name].set_visible(len(points) > 1)
+        self.overlay_artists[name + '_ends'].set_data(xs, ys)
+        self.overlay_artists[name + '_ends'].set_visible(len(points) > 0)
+
+    def screen_factor(self, x0, x1, y0, y1):
+        # Whole number of image pixels that fall on one screen pixel for the visible area (at least 1)
+        bbox = self.ax.get_window_extent()
+        screen_width, screen_height = max(1.0, bbox.width), max(1.0, bbox.height)
+        return max(1, int(min((x1 - x0) / screen_width, (y1 - y0) / screen_height)))
+
+    def visible_region(self, shape, x0, x1, y0, y1, factor):
+        # Pixel bounds (x0, x1, y0, y1) covering the visible area, rounded up to whole blocks of
+        # factor x factor pixels, dropping the partial block at the image edge
+        img_height, img_width = shape
+        cx0, cy0 = int(math.floor(x0)), int(math.floor(y0))
+        cx1 = max(cx0 + 1, int(math.ceil(x1)))
+        cy1 = max(cy0 + 1, int(math.ceil(y1)))
+        cx1 = min(img_width, cx0 + -(-(cx1 - cx0) // factor) * factor)
+        cy1 = min(img_height, cy0 + -(-(cy1 - cy0) // factor) * factor)
+        if cx1 - cx0 >= factor and cy1 - cy0 >= factor:
+            cx1 = cx0 + (cx1 - cx0) // factor * factor
+            cy1 = cy0 + (cy1 - cy0) // factor * factor
+        return cx0, cx1, cy0, cy1
+
+    def overlay_geometry(self, frame=None):
+        # ({key: drawn segment}, keys, (keys, 2, 2) array) of h and H offset beside the bone line. Cached per
+        # frame until that frame's measurements or bone line change; drawing and hit-testing both use it.
+        frame = self.frame_index if frame is None else frame
+        revision = self.store.revision(frame)
+        cached = self.overlay_cache.get(frame)
+        if cached is None or cached[0] != revision:
+            segments = geometry.measurement_segments(self.measurements.get(frame, {}), self.bone_lines.get(frame),
+                                                     geometry.VISUAL_OFFSET)
+            keys = list(segments)
+            cached = (revision, segments, keys, np.array([segments[key] for key in keys]).reshape(-1, 2, 2))
+            self.overlay_cache[frame] = cached
+        return cached[1:]
+
+    def update_overlays(self):
+        # Measurements overlays: h and H are drawn beside the bone line (h below, H above), not on it
+        segments, _, _ = self.overlay_geometry()
+        for key in ('h', 'H'):
+            self.set_overlay(key, list(segments.get(key, ())))
+
+        # Bone line (cyan dashed) if it was confirmed for this frame
+        self.set_overlay('bone', list(self.bone_lines.get(self.frame_index, ())))
+
+        # Bone points before confirmation (one point, or two points connected with a dashed line)
+        self.set_overlay('preview', self.points[:2])
+
+    # BLITTING (drag and bone line preview only move a few lines, the image underneath stays the same)
+    def start_blit(self):
+        # Render the figure once without the overlays and keep it as the background
+        for artist in self.overlay_artists.values():
+            artist.set_animated(True)
+        self.canvas.draw()
+        self.blit_background = self.canvas.copy_from_bbox(self.ax.bbox)
+
+    def blit_overlays(self):
+        if self.blit_background is None:
+            self.start_blit()
+        self.canvas.restore_region(self.blit_background)
+        for artist in self.overlay_artists.values():
+            if artist.get_visible():
+                self.ax.draw_artist(artist)
+        self.canvas.blit(self.ax.bbox)
+
+    def stop_blit(self):
+        if self.blit_background is None:
+            return
+        self.blit_background = None
+        for artist in self.overlay_artists.values():
+            artist.set_animated(False)
+
     def show_frame(self):
 
         if not self.dicom:                          # If there is no DICOM data loaded:
             self.slider.config(state='disabled')    # hide the slider
             self.ax.clear()                         # make sure the axes are cleared
             self.ax.axis('off')                     # turn off axes
+            self.image_artist = None                # artists are rebuilt for the next file
             self.canvas.draw_idle()                 # update the canvas
             return
 
-        # We are mostly working with multi frame DICOMs (3D array), otherwise a single frame is 2D array
-        frame = self.pixel_data[self.frame_index] if self.pixel_data.ndim == 3 else self.pixel_data
-        # Apply window level
-        frame = self.apply_window_level(frame)
-        self.ax.clear()
-        self.ax.axis('off')
+        self.stop_blit()                            # full redraw, the blit background would be stale
+        if self.render_after_id is not None:        # this redraw already covers any scheduled one
+            self.root.after_cancel(self.render_after_id)
+            self.render_after_id = None
 
-        # frame.shape[1] is width, frame.shape[0] is height
-        self.ax.imshow(frame, cmap='gray', aspect='equal', extent=[0, frame.shape[1], frame.shape[0], 0])
-        self.figure.subplots_adjust(left=0, right=1, top=1, bottom=0) # remove padding around the image
-
-        self.ax.set_xlim(0, frame.shape[1]) # Set limits to show entire image
-        self.ax.set_ylim(frame.shape[0], 0) # Flip y axis for correct orientation
+        if self.image_artist is None:
+            self.create_artists()
 
         # Zoom
-        img_height, img_width = frame.shape             
+        img_height, img_width = self.frames.frame_shape
         zoom_fraction = self.zoom_level / 100.0         
         zoom_width = img_width * (1 - zoom_fraction)
         zoom_height = img_height * (1 - zoom_fraction)
@@ -315,63 +757,29 @@ class DICOMViewer:
         self.ax.set_xlim(x0, x1)
         self.ax.set_ylim(y1, y0)  # flip y axis
 
-        # Measurements overlays
-        dot = 'o'
-        dotsize = 0.5
-        linesize = 0.8
-
-        # get { 'h': (p1, p2),  'H': (p1, p2) } for the current frame
-        frame_measures = self.measurements.get(self.frame_index, {})
-        # for each h and H, draw the lines and points
-        for key, color, offset_dir in [('h', 'red', -1), ('H', 'yellow', 1)]:
-            if key in frame_measures:
-                p1, p2 = frame_measures[key]
-
-                # Get bone slope and normal vector
-                bone = self.bone_lines.get(self.frame_index)
-                if bone:
-                    (x1, y1), (x2, y2) = bone
-                    dx, dy = x2 - x1, y2 - y1
-                    if dx == dy == 0:
-                        offset_x, offset_y = 0, 0
-                    else:
-                        # Perpendicular unit vector to bone line
-                        normal_x, normal_y = -dy, dx
-                        length = (normal_x ** 2 + normal_y ** 2) ** 0.5
-                        normal_x /= length
-                        normal_y /= length
-
-                        offset_amount = 8  # You can tweak this value
-                        offset_x = normal_x * offset_amount * offset_dir
-                        offset_y = normal_y * offset_amount * offset_dir
-                else:
-                    offset_x, offset_y = 0, 0
-
-                # Offset drawing only
-                p1o = (p1[0] + offset_x, p1[1] + offset_y)
-                p2o = (p2[0] + offset_x, p2[1] + offset_y)
-
-                self.ax.plot([p1o[0], p2o[0]], [p1o[1], p2o[1]], color=color, linewidth=linesize)
-                self.ax.plot(p1o[0], p1o[1], marker=dot, markersize=dotsize, color=color)
-                self.ax.plot(p2o[0], p2o[1], marker=dot, markersize=dotsize, color=color)
-
-
-        # Draw the bone line (cyan dashed) if it was confirmed for this frame
-        if self.frame_index in self.bone_lines:
-            p1, p2 = self.bone_lines[self.frame_index]
-            self.ax.plot([p1[0], p2[0]], [p1[1], p2[1]], linestyle='dashed', linewidth=linesize, color='cyan', alpha=0.4)  # 0 < alpha < 1 
-            self.ax.plot(p1[0], p1[1], marker=dot, markersize=dotsize, color='cyan')
-            self.ax.plot(p2[0], p2[1], marker=dot, markersize=dotsize, color='cyan')
-
-        # Bone points before confirmation
-        if len(self.points) == 1:   # one point clicked
-            self.ax.plot(self.points[0][0], self.points[0][1], marker=dot, markersize=dotsize, color='cyan')
+        # Only the visible part of the frame, reduced to about screen resolution, is handed to matplotlib.
+        # Zoomed out views read from the frame's image pyramid (level 1 = 1/2 size, level 2 = 1/4 ...)
+        # and only area-average what is left. The image is only swapped when something actually changed.
+        factor = self.screen_factor(x0, x1, y0, y1)
+        level = self.frames.pyramid_level(factor)
+        scale = 2 ** level
+        factor //= scale
+        level_shape = (img_height // scale, img_width // scale)
+        crop = self.visible_region(level_shape, x0 / scale, x1 / scale, y0 / scale, y1 / scale, factor)
+        image_key = (self.frame_index, self.window_center, self.window_width, level, crop, factor)
+        if image_key != self.image_key:
+            cx0, cx1, cy0, cy1 = crop
+            if level == 0:
+                # Window-levelled frame, usually already prepared by the prefetcher
+                image = self.get_windowed_frame(self.frame_index)[cy0:cy1, cx0:cx1]
+            else:
+                image = self.apply_window_level(self.frames.get_level(self.frame_index, level)[cy0:cy1, cx0:cx1])
+            self.image_artist.set_data(area_average(image, factor))
+            self.image_artist.set_extent([cx0 * scale, cx1 * scale, cy1 * scale, cy0 * scale])
+            self.image_key = image_key
+        self.prefetch_ahead(self.frame_index, level)
 
-        elif len(self.points) == 2: # two points clicked, connect with dashed line
-            p1, p2 = self.points
-            self.ax.plot([p1[0], p2[0]], [p1[1], p2[1]], linestyle='dashed', linewidth=linesize, color='cyan')
-            self.ax.plot(p1[0], p1[1], marker=dot, markersize=dotsize, color='cyan')
-            self.ax.plot(p2[0], p2[1], marker=dot, markersize=dotsize, color='cyan')
+        self.update_overlays()
 
         # Update frame index label and slider
         self.frame_label.config(text=f"Frame {self.frame_index + 1} / {self.num_frames}")
@@ -395,6 +803,7 @@ class DICOMViewer:
         slope = dy / dx if dx != 0 else float('inf')
         self.bone_lines[self.frame_index] = tuple(self.points)
         self.bone_slope[self.frame_index] = slope
+        self.journal_frames([self.frame_index])
 
         self.text_box.config(text="Step 3: Click the edge of the epiphysis")
         self.points.clear()                                                     # Clear point storage for h step
@@ -460,6 +869,7 @@ class DICOMViewer:
 
             self.measurements[self.frame_index]['h'] = (proj1, proj2)           # Store h measurements in current frame's measurements dict 
             self.measurements[self.frame_index]['raw_clicks'] = (p1, p2)        # Only 2 clicks for now, H click comes later
+            self.journal_frames([self.frame_index])
 
             self.text_box.config(text="Step 5: Click the next joint")           # Prompt next step for H measurement
             self.measure_step = 'H_step'
@@ -484,101 +894,33 @@ class DICOMViewer:
             # Update raw_clicks tuple to include H's first click
             click1, click2 = self.measurements[self.frame_index]['raw_clicks']
             self.measurements[self.frame_index]['raw_clicks'] = (click1, click2, p1)
+            self.journal_frames([self.frame_index])
 
             self.measure_step = None                                            
             self.show_frame()
             return
 
-        frame_measures = self.measurements.get(self.frame_index, {})    # Current frame's measurements {'h': (p1, p2), 'H': (p1, p2)}
-
         threshold_line = 15      # bigger threshold for clicking/dragging the line
         threshold_endpoints = 5  # smaller threshold for endpoints
 
-        # Get squared distance between 2 points
-        def dist_sq(a, b):
-            return (a[0] - b[0])**2 + (a[1] - b[1])**2
-
-        # Instead of looping directly, collect possible hits and pick the closest
-        possible_hits = []
-        for key, (p1, p2) in frame_measures.items():
-            offset_dir = -1 if key == 'h' else 1
-            bone = self.bone_lines.get(self.frame_index)
-            if bone:
-                (x1, y1), (x2, y2) = bone
-                dx, dy = x2 - x1, y2 - y1
-                if dx == dy == 0:
-                    offset_x = offset_y = 0
-                else:
-                    normal_x, normal_y = -dy, dx
-                    length = (normal_x ** 2 + normal_y ** 2) ** 0.5
-                    normal_x /= length
-                    normal_y /= length
-                    offset_amount = 5
-                    offset_x = normal_x * offset_amount * offset_dir
-                    offset_y = normal_y * offset_amount * offset_dir
-            else:
-                offset_x = offset_y = 0
-
-            p1_vis = (p1[0] + offset_x, p1[1] + offset_y)
-            p2_vis = (p2[0] + offset_x, p2[1] + offset_y)
-
-            # Check endpoints
-            if dist_sq((x, y), p1_vis) < threshold_endpoints**2:
-                possible_hits.append((math.hypot(x - p1_vis[0], y - p1_vis[1]), key, 'p1'))
-            if dist_sq((x, y), p2_vis) < threshold_endpoints**2:
-                possible_hits.append((math.hypot(x - p2_vis[0], y - p2_vis[1]), key, 'p2'))
-
-            # Pick the closest hit, but endpoints always win over lines
-            if possible_hits:
-                type_priority = lambda part: 0 if part in ('p1', 'p2') else 1
-                _, key, part = min(possible_hits, key=lambda h: (type_priority(h[2]), h[0]))
-                self.selected_point = (key, part)
-                self.dragging = True
-                if part == 'line':
-                    self.drag_offset = (x, y)
-                print(f"clicked on {key} {part}")
-                return  # <<< prevent second block from running
-
-        for key, (p1, p2) in frame_measures.items():
-            # Offset drawing logic for h and H
-            offset_dir = -1 if key == 'h' else 1
-            bone = self.bone_lines.get(self.frame_index)
-            if bone:
-                (x1, y1), (x2, y2) = bone
-                dx, dy = x2 - x1, y2 - y1
-                if dx == dy == 0:
-                    offset_x = offset_y = 0
-                else:
-                    normal_x, normal_y = -dy, dx
-                    length = (normal_x ** 2 + normal_y ** 2) ** 0.5
-                    normal_x /= length
-                    normal_y /= length
-                    offset_amount = 5
-                    offset_x = normal_x * offset_amount * offset_dir
-                    offset_y = normal_y * offset_amount * offset_dir
-            else:
-                offset_x = offset_y = 0
-
-            # Apply visual offset to p1 and p2
-            p1_vis = (p1[0] + offset_x, p1[1] + offset_y)
-            p2_vis = (p2[0] + offset_x, p2[1] + offset_y)
-
-            if dist_sq((x, y), p1_vis) < threshold_endpoints**2:
-                self.selected_point = (key, 'p1')
-                self.dragging = True
-                print("clicked on p1")
-                return
-            if dist_sq((x, y), p2_vis) < threshold_endpoints**2:
-                self.selected_point = (key, 'p2')
-                self.dragging = True
-                print("clicked on p2")
-                return
-            if self.point_near_line((x, y), p1_vis, p2_vis, threshold_line):
-                self.selected_point = (key, 'line')
-                self.dragging = True
-                self.drag_offset = (x, y)
-                print("clicked on line")
-                return
+        # h and H exactly where they are drawn (offset from the bone line), hit-tested all at once
+        segments, keys, segment_array = self.overlay_geometry()
+        if not segments:
+            return
+        endpoint_dists = geometry.point_distances((x, y), segment_array)                # (keys, 2)
+        line_dists = geometry.segment_distances((x, y), segment_array[:, 0], segment_array[:, 1])
+
+        # Pick the closest hit, but endpoints always win over lines
+        if (endpoint_dists < threshold_endpoints).any():
+            k, end = np.unravel_index(np.argmin(endpoint_dists), endpoint_dists.shape)
+            self.selected_point = (keys[k], 'p1' if end == 0 else 'p2')
+        elif (line_dists <= threshold_line).any():
+            self.selected_point = (keys[int(np.argmin(line_dists))], 'line')
+            self.drag_offset = (x, y)
+        else:
+            return
+        self.dragging = True
+        print(f"clicked on {self.selected_point[0]} {self.selected_point[1]}")
 
     def on_mouse_move(self, event):
 
@@ -587,7 +929,7 @@ class DICOMViewer:
             dy = event.y - self.last_pan_xy[1]
             self.last_pan_xy = (event.x, event.y)
 
-            img_height, img_width = self.pixel_data[0].shape if self.pixel_data.ndim == 3 else self.pixel_data.shape
+            img_height, img_width = self.frames.frame_shape
             zoom_fraction = self.zoom_level / 100.0
             visible_width = img_width * (1 - zoom_fraction)
             visible_height = img_height * (1 - zoom_fraction)
@@ -605,7 +947,13 @@ class DICOMViewer:
             self.pan_offset[0] -= data_dx
             self.pan_offset[1] += data_dy  # Inverted y-axis
 
-            self.show_frame()
+            self.request_render()
+            return
+
+        # Live bone line preview from the first click to the cursor
+        if self.dicom and self.measure_step == 'bone_end' and len(self.points) == 1 and event.inaxes == self.ax:
+            self.set_overlay('preview', [self.points[0], (event.xdata, event.ydata)])
+            self.blit_overlays()
             return
 
         if not self.dicom or not self.dragging or event.inaxes != self.ax or not self.selected_point:
@@ -680,7 +1028,10 @@ class DICOMViewer:
             self.measurements[self.frame_index][key] = (new_p1, new_p2)
             self.drag_offset = (x, y)
 
-        self.show_frame()
+        # Only the overlay lines moved, redraw them over the cached image
+        self.update_overlays()
+        self.blit_overlays()
+        self.update_measurement_label()
 
     def on_mouse_release(self, event):
         if self.is_panning:
@@ -688,47 +1039,17 @@ class DICOMViewer:
             self.last_pan_xy = None
             return
 
+        if self.dragging and self.selected_point:
+            self.journal_frames([self.frame_index])     # drag finished, record the adjusted measurement
         self.dragging = False
         self.selected_point = None
         self.show_frame()
 
-    def point_near_line(self, pt, line_start, line_end, threshold):
-        x, y = pt
-        x1, y1 = line_start
-        x2, y2 = line_end
-        if (x1 == x2) and (y1 == y2):
-            return False
-        vx, vy = x2 - x1, y2 - y1
-        wx, wy = x - x1, y - y1
-        c1 = vx * wx + vy * wy
-        if c1 <= 0:
-            return (x - x1)**2 + (y - y1)**2 <= threshold**2
-        c2 = vx * vx + vy * vy
-        if c2 <= c1:
-            return (x - x2)**2 + (y - y2)**2 <= threshold**2
-        b = c1 / c2
-        pbx = x1 + b * vx
-        pby = y1 + b * vy
-        return (x - pbx)**2 + (y - pby)**2 <= threshold**2
-
     def calculate_distance(self, p1, p2):
-        dx = (p2[0] - p1[0]) * self.pixel_spacing[1]
-        dy = (p2[1] - p1[1]) * self.pixel_spacing[0]
-        return (dx ** 2 + dy ** 2) ** 0.5
-    
-    def project_point_onto_line(self, pt, line_p1, line_p2):    # Perpendicularly project pt onto line defined by line_p1 and line_p2
+        return float(geometry.distances_mm(p1, p2, self.pixel_spacing))
 
-        x0, y0 = pt                     # point to project onto bone line
-        x1, y1 = line_p1                # bone line start
-        x2, y2 = line_p2                # bone line end
-        dx, dy = x2 - x1, y2 - y1       # direction vector of bone line
-        if dx == 0 and dy == 0:
-            return (x1, y1)
-        
-        # Calculate the projection of point onto the line (dot product divided by direction vector squared)
-        scalar_proj = ((x0 - x1)*dx + (y0 - y1)*dy) / (dx*dx + dy*dy)
-        # Projected point coordinates
-        return (x1 + scalar_proj*dx, y1 + scalar_proj*dy)
+    def project_point_onto_line(self, pt, line_p1, line_p2):    # Perpendicularly project pt onto line defined by line_p1 and line_p2
+        return tuple(geometry.project_points(pt, line_p1, line_p2).tolist())
 
     def update_measurement_label(self):
         frame_measures = self.measurements.get(self.frame_index, {})
@@ -761,6 +1082,7 @@ class DICOMViewer:
             del self.bone_lines[self.frame_index]
         if self.frame_index in self.bone_slope:
             del self.bone_slope[self.frame_index]
+        self.journal_frames([self.frame_index])
 
         self.points.clear()
         self.selected_point = None
@@ -793,9 +1115,9 @@ class DICOMViewer:
             return
 
         try:
-            with open(file1, "rb") as f1, open(file2, "rb") as f2:
-                data1 = pickle.load(f1)
-                data2 = pickle.load(f2)
+            # Only the header, measurements and labels sections are needed here
+            data1 = working_file.load_state(file1, sections=("measurements", "labels"))
+            data2 = working_file.load_state(file2, sections=("measurements", "labels"))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load working files:\n{e}")
             return
@@ -803,23 +1125,16 @@ class DICOMViewer:
         meas1 = data1.get("measurements", {})
         meas2 = data2.get("measurements", {})
 
-        labels1 = data1.get("frame_joint_labels", {})
-        labels2 = data2.get("frame_joint_labels", {})
 
         def get_row_col_spacing_from_dicom(state_path, state_dict):
             folder = os.path.dirname(state_path)
             dicom_filename = state_dict.get("dicom_filename")
             if dicom_filename:
                 dicom_path = os.path.join(folder, dicom_filename)
-                if os.path.exists(dicom_path):
-                    try:
-                        ds = pydicom.dcmread(dicom_path, stop_before_pixels=True)
-                        if hasattr(ds, "PixelSpacing") and len(ds.PixelSpacing) >= 2:
-                            rs = float(ds.PixelSpacing[0])  # mm per row
-                            cs = float(ds.PixelSpacing[1])  # mm per column
-                            return rs, cs
-                    except Exception:
-                        pass
+                # (mm per row, mm per column) from the header cache, parsed only if the file is new or changed
+                spacing = self.header_cache.spacing(dicom_path)
+                if spacing:
+                    return spacing
             # fallback to whatever was stored in the state
             ps = state_dict.get("pixel_spacing", None)
             if ps and len(ps) >= 2:
@@ -831,21 +1146,20 @@ class DICOMViewer:
 
         row_spacing1, col_spacing1 = get_row_col_spacing_from_dicom(file1, data1)
         row_spacing2, col_spacing2 = get_row_col_spacing_from_dicom(file2, data2)
+        self.header_cache.save()
 
-        # Load pixel data from the first DICOM (for plotting frames)
-        pixel_data1 = None
+        # Open the first DICOM for plotting frames; pixels are only decoded for the frames that get an image
+        frames1 = None
         folder1 = os.path.dirname(file1)
         dicom_filename1 = data1.get("dicom_filename")
         if dicom_filename1:
             dicom_path1 = os.path.join(folder1, dicom_filename1)
             if os.path.exists(dicom_path1):
                 try:
-                    ds1 = pydicom.dcmread(dicom_path1)
-                    pixel_data1 = ds1.pixel_array
+                    frames1 = FrameProvider(pydicom.dcmread(dicom_path1, defer_size='1 MB'))
                 except Exception as e:
                     messagebox.showwarning("Warning", f"Could not load pixel data from {dicom_path1}:\n{e}")
-                    pixel_data1 = None
-
+                    frames1 = None
 
         # Prepare new Excel workbook
         wb = Workbook()
@@ -870,90 +1184,26 @@ class DICOMViewer:
             "Click3 Dist (mm)"
         ])
 
-        def coord_diff_mm(p1, p2):
-            if p1 is None or p2 is None:
-                return None, None
-            # convert each click to mm independently
-            x1_mm = p1[0] * col_spacing1
-            y1_mm = p1[1] * row_spacing1
-            x2_mm = p2[0] * col_spacing2
-            y2_mm = p2[1] * row_spacing2
-            return abs(x1_mm - x2_mm), abs(y1_mm - y2_mm)
-
-
-        # Compare each joint — match by (joint, frame) and control output order
-        desired_order = ["PD4", "PD3", "PD2", "PD5", "PM5", "PM4", "PM3", "PM2",
-                        "PP5", "MC5", "PP4", "MC4", "PP3", "MC3", "PP2", "MC2", "PD1"]
-
-        all_joints = set(labels1.values()).union(labels2.values())
-        # Preserve your desired order first, then append any unexpected joints alphabetically
-        ordered_joints = [j for j in desired_order if j in all_joints] + \
-                        sorted(all_joints - set(desired_order))
+        # Align both files on (joint, frame) and compute every click difference in one pass. Per joint the
+        # frames labelled in both files come first, then those only in file1, then only in file2.
+        comparison = rater_comparison.RaterComparison(data1.get("dicom_filename"), [
+            rater_comparison.rater_from_state(file1_name, data1, (row_spacing1, col_spacing1),
+                                              rater_comparison.study_key(file1, data1, self.header_cache)),
+            rater_comparison.rater_from_state(file2_name, data2, (row_spacing2, col_spacing2),
+                                              rater_comparison.study_key(file2, data2, self.header_cache)),
+        ])
 
         row_idx = 2  # start writing after header
-
-        # Build sets of (frame, joint) pairs for each file
-        pairs1 = {(f, j) for f, j in labels1.items()}
-        pairs2 = {(f, j) for f, j in labels2.items()}
-
-        # Intersection = same joint AND same frame in both files
-        common_pairs = pairs1 & pairs2
-        # Differences = present only in one file
-        only1 = pairs1 - pairs2
-        only2 = pairs2 - pairs1
-
-        def write_row(joint, f1_idx, f2_idx):
-            nonlocal row_idx
-
-            f1 = meas1.get(f1_idx, {}) if f1_idx is not None else {}
-            f2 = meas2.get(f2_idx, {}) if f2_idx is not None else {}
-
-            rc1 = f1.get('raw_clicks', (None, None, None))
-            rc2 = f2.get('raw_clicks', (None, None, None))
-
-            diffs = [coord_diff_mm(rc1[k], rc2[k]) for k in range(3)]
-            
-            # Euclidean distance in mm using per-file spacings
-            dists = []
-            for k in range(3):
-                dx, dy = coord_diff_mm(rc1[k], rc2[k])
-                if dx is None or dy is None:
-                    dists.append(None)
-                else:
-                    dists.append((dx**2 + dy**2) ** 0.5)
-
-
+        for _, _, joint, f1_idx, f2_idx, values in comparison.difference_rows():
             ws.cell(row=row_idx, column=1, value=joint)
             ws.cell(row=row_idx, column=2, value=(f1_idx + 1) if f1_idx is not None else "")
             ws.cell(row=row_idx, column=3, value=(f2_idx + 1) if f2_idx is not None else "")
-
-            col_idx = 4
-            for dx, dy in diffs:
-                write_number(ws, row_idx, col_idx, dx)
-                write_number(ws, row_idx, col_idx + 1, dy)
-                col_idx += 2
-
-            for dist in dists:
-                write_number(ws, row_idx, col_idx, dist)
-                col_idx += 1
-
+            for col_idx, value in enumerate(values, start=4):
+                write_number(ws, row_idx, col_idx, value)
             row_idx += 1
 
-        for joint in ordered_joints:
-            # rows where BOTH files have the same (joint, frame)
-            frames_common = sorted([f for (f, j) in common_pairs if j == joint])
-            for f in frames_common:
-                write_row(joint, f, f)
-
-            # show frames present only in file1 (left) / only in file2 (right)
-            frames_only1 = sorted([f for (f, j) in only1 if j == joint])
-            for f in frames_only1:
-                write_row(joint, f, None)
-
-            frames_only2 = sorted([f for (f, j) in only2 if j == joint])
-            for f in frames_only2:
-                write_row(joint, None, f)
-
+        # ICC, Bland-Altman and per-joint MAD of the two files on extra sheets
+        reliability.write_sheets(wb, [comparison])
 
         for i, col_cells in enumerate(ws.columns, 1):
             col_letter = get_column_letter(i)
@@ -973,77 +1223,42 @@ class DICOMViewer:
             title="Save Differences As")
 
         if not save_path:
+            if frames1 is not None:
+                frames1.close()
             return
 
-        # Plot file1 and file2's clicks and save to folder
-        excel_folder = os.path.splitext(save_path)[0]  # remove .xlsx
-        os.makedirs(excel_folder, exist_ok=True)
-
-        def save_frame_image(frame_index, frame_data, clicks1, clicks2, base_folder):
-            fig = Figure(figsize=(6,6), dpi=150)
-            canvas = FigureCanvas(fig)
-            ax = fig.add_subplot(111)
-            ax.imshow(frame_data, cmap='gray', aspect='equal', extent=[0, frame_data.shape[1], frame_data.shape[0], 0])
-            ax.axis('off')
-
-            color1 = ['cyan', 'springgreen', 'dodgerblue']
-            color2 = ['blueviolet', 'deeppink', 'lightpink']
-            marker_size = 4  # smaller points
-            alpha_val = 0.8  # slight transparency
-
-            # Plot file1 clicks
-            if clicks1:
-                for k, p in enumerate(clicks1):
-                    if p is not None:
-                        ax.plot(
-                            p[0], p[1],
-                            marker='x',
-                            color=color1[k],
-                            markersize=marker_size,
-                            markeredgewidth=0.8,
-                            alpha=alpha_val,
-                            linestyle='None',
-                            label=f'File 1 Click {k+1}')
-
-            # Plot file2 clicks
-            if clicks2:
-                for k, p in enumerate(clicks2):
-                    if p is not None:
-                        ax.plot(
-                            p[0], p[1],
-                            marker='x',
-                            color=color2[k],
-                            markersize=marker_size,
-                            markeredgewidth=0.8,
-                            alpha=alpha_val,
-                            linestyle='None',
-                            label=f'File 2 Click {k+1}')
-
-            # Add legend showing all 6 clicks
-            ax.legend(loc='upper right', fontsize=6, framealpha=0.5)
-
-            out_path = os.path.join(base_folder, f"frame_{frame_index+1:03d}.png")
-            fig.savefig(out_path, bbox_inches='tight', pad_inches=0)
-            plt.close(fig)
-
-            out_path = os.path.join(base_folder, f"frame_{frame_index+1:03d}.png")
-            fig.savefig(out_path, bbox_inches='tight', pad_inches=0)
-            plt.close(fig)
-
-        if pixel_data1 is not None:
-            for f_idx in sorted(set(meas1.keys()).union(meas2.keys())):
-                if f_idx >= pixel_data1.shape[0]:
-                    continue  # skip out-of-bounds
-                frame_data = pixel_data1[f_idx]  # multi-frame
-                clicks1 = meas1.get(f_idx, {}).get('raw_clicks', (None,None,None))
-                clicks2 = meas2.get(f_idx, {}).get('raw_clicks', (None,None,None))
-                save_frame_image(f_idx, frame_data, clicks1, clicks2, excel_folder)
-
         try:
             wb.save(save_path)
-            messagebox.showinfo("Success", f"Measurement differences exported to:\n{save_path}")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save Excel file:\n{e}")
+            if frames1 is not None:
+                frames1.close()
+            return
+
+        # Plot file1 and file2's clicks for every frame measured in either file, one image per frame
+        excel_folder = os.path.splitext(save_path)[0]  # remove .xlsx
+        os.makedirs(excel_folder, exist_ok=True)
+
+        frames_to_plot = []
+        if frames1 is not None:
+            frames_to_plot = [f_idx for f_idx in sorted(set(meas1.keys()).union(meas2.keys()))
+                              if f_idx < frames1.num_frames]    # skip out-of-bounds
+
+        def make_job(f_idx):
+            clicks1 = meas1.get(f_idx, {}).get('raw_clicks', (None,None,None))
+            clicks2 = meas2.get(f_idx, {}).get('raw_clicks', (None,None,None))
+            return (image_export.render_click_comparison_image,
+                    image_export.frame_image_path(excel_folder, f_idx), np.asarray(frames1.get(f_idx)), clicks1, clicks2)
+
+        def on_images_saved(error):
+            if frames1 is not None:
+                frames1.close()
+            if error is not None:
+                messagebox.showerror("Error", f"Failed to save comparison images:\n{error}")
+            else:
+                messagebox.showinfo("Success", f"Measurement differences exported to:\n{save_path}")
+
+        self.render_images_in_background(frames_to_plot, make_job, on_images_saved)
 
 
     def prev_frame(self):
@@ -1060,7 +1275,7 @@ class DICOMViewer:
         frame_num = int(val) - 1
         if frame_num != self.frame_index:
             self.frame_index = frame_num
-            self.show_frame()
+            self.request_render()
 
     def on_mouse_wheel(self, event):
         if not self.dicom or self.num_frames <= 1:
@@ -1118,158 +1333,140 @@ class DICOMViewer:
 
         save_path = filedialog.asksaveasfilename(
             defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx")],
+            filetypes=measurement_export.FILE_TYPES,
             initialfile=suggested_name,
             title="Save Measurements As")
 
         if not save_path:
             return
 
-        # Get pixel spacing (mm per pixel) from DICOM metadata
-        row_spacing = col_spacing = 1.0
-        if hasattr(self.dicom, "PixelSpacing"):
-            try:
-                row_spacing = float(self.dicom.PixelSpacing[0])  # mm per pixel vertically
-                col_spacing = float(self.dicom.PixelSpacing[1])  # mm per pixel horizontally
-            except:
-                pass
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Measurements"
-
-        # Excel Header (first row)
-        ws.append([
-            "Filename", "Frame", "h (mm)", "H (mm)", "OR (%)",
-            "Click 1 x", "Click 1 y",
-            "Click 2 x", "Click 2 y",
-            "Click 3 x", "Click 3 y"
-        ])
-
         filename = os.path.basename(self.dicom.filename) if self.dicom and hasattr(self.dicom, 'filename') else "Unknown"
 
-        def write_number(ws, row, col, value):
-            """Write a float with 2 decimal places to Excel."""
-            if value is None or value == "":
-                ws.cell(row=row, column=col, value="")
-            else:
-                ws.cell(row=row, column=col, value=round(float(value), 2))
-                ws.cell(row=row, column=col).number_format = "0.00"
-
-        # Write each frame
-        for frame_num in sorted(self.measurements.keys()):
-            frame_data = self.measurements[frame_num]
-
-            # Optional: keep original h/H distances if present
-            h_dist = round(self.calculate_distance(*frame_data['h']), 2) if 'h' in frame_data else None
-            H_dist = round(self.calculate_distance(*frame_data['H']), 2) if 'H' in frame_data else None
-            or_ratio = round(h_dist / H_dist * 100, 1) if h_dist is not None and H_dist not in (None, 0) else ""
-
-            # Pull raw clicks
-            raw_clicks = frame_data.get('raw_clicks', (None, None, None))
-            click_coords_mm = []
-            for p in raw_clicks:
-                if p is not None:
-                    click_coords_mm.extend([p[0] * col_spacing, p[1] * row_spacing])
-                else:
-                    click_coords_mm.extend([None, None])
-
-            # Write row to Excel with 2 decimal places
-            row_idx = ws.max_row + 1
-            ws.cell(row=row_idx, column=1, value=filename)         # Filename
-            ws.cell(row=row_idx, column=2, value=frame_num + 1)   # Frame
-            write_number(ws, row_idx, 3, h_dist)                  # h (mm)
-            write_number(ws, row_idx, 4, H_dist)                  # H (mm)
-            write_number(ws, row_idx, 5, or_ratio)                # OR (%)
-
-            # Clicks 1-3
-            col_idx = 6
-            for val in click_coords_mm:
-                write_number(ws, row_idx, col_idx, val)
-                col_idx += 1
-
-        # Save Excel
+        # h, H, OR and clicks in mm for every frame in one pass, written by the backend matching the extension
+        columns = measurement_export.measurement_columns(filename, self.measurements, self.pixel_spacing)
+
+        # Save Excel / CSV / Parquet
         try:
-            wb.save(save_path)
+            measurement_export.write_columns(save_path, columns)
 
-            # Save images if checkbox is checked
+            # Save images if checkbox is checked (in the background, the message waits until they are done)
             if self.save_images_var.get():
                 image_folder = os.path.splitext(save_path)[0] + "_images"
-                self.save_images(image_folder)
 
-            messagebox.showinfo("Success", f"Measurements exported to:\n{save_path}")
-            self.focus_app_window()
+                def on_images_saved(error):
+                    if error is not None:
+                        messagebox.showerror("Error", f"Failed to save images:\n{error}")
+                    else:
+                        messagebox.showinfo("Success", f"Measurements exported to:\n{save_path}\nImages saved to:\n{image_folder}")
+                    self.focus_app_window()
+
+                self.save_images(image_folder, on_images_saved)
+            else:
+                messagebox.showinfo("Success", f"Measurements exported to:\n{save_path}")
+                self.focus_app_window()
 
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to save Excel file:\n{e}")
+            messagebox.showerror("Error", f"Failed to save measurements file:\n{e}")
 
         self.focus_app_window()
 
-    def save_images(self, base_folder):
-        # Extract base name of loaded DICOM file (without extension)
-        dicom_basename = os.path.splitext(os.path.basename(self.dicom.filename))[0] \
-            if self.dicom and hasattr(self.dicom, 'filename') else "DICOM"
-
-        # Save directly to the base folder
-        save_folder = base_folder
-        os.makedirs(save_folder, exist_ok=True)
+    def save_images(self, base_folder, on_done=None):
+        # Render every measured frame to a PNG across a process pool. Each worker only gets that frame's
+        # pixels and overlay geometry.
+        os.makedirs(base_folder, exist_ok=True)
+
+        # Jobs are built while the user keeps working, so they read a snapshot taken now: the frame provider
+        # of this study and a copy of its measurements and bone lines
+        frames, num_frames, store = self.frames, self.num_frames, self.store.copy()
+        measurements, bone_lines = store.measurements, store.bone_lines
+
+        frames_to_save = [i for i in sorted(measurements)
+                          if i < num_frames and ('h' in measurements[i] or 'H' in measurements[i])]
+
+        def make_job(i):
+            bone = bone_lines.get(i)
+            overlays = image_export.measurement_overlays(measurements[i], bone)     # same offsets as on screen
+            return (image_export.render_measurement_image,
+                    image_export.frame_image_path(base_folder, i), np.asarray(frames.get(i)), bone, overlays)
+
+        self.render_images_in_background(frames_to_save, make_job, on_done)
+
+    def render_images_in_background(self, items, make_job, on_done=None):
+        # Run make_job(item) -> (func, *args) for every item on a process pool while a progress window is
+        # updated from the Tk loop. Jobs are only built when a slot frees up, so frames are decoded lazily;
+        # the viewer stays usable meanwhile, so make_job must only read state captured when the export
+        # started (see save_images), never the live measurements. Closing the progress window cancels the
+        # frames not started yet. on_done gets the first error (a RuntimeError if cancelled), or None.
+        if not items:
+            if on_done:
+                on_done(None)
+            return
 
-        original_index = self.frame_index
+        progress_win = tk.Toplevel(self.root)
+        progress_win.title("Saving images")
+        progress_label = tk.Label(progress_win, text=f"Saving images 0 / {len(items)}")
+        progress_label.pack(padx=20, pady=(10, 5))
+        progress_bar = ttk.Progressbar(progress_win, length=250, maximum=len(items))
+        progress_bar.pack(padx=20, pady=(0, 10))
+
+        workers = os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=workers)
+        pending = list(items)
+        running = set()
+        errors = []
         saved_count = 0
+        cancelled = False
 
-        for i in range(self.num_frames):
-            frame_measures = self.measurements.get(i, {})
-            if not ('h' in frame_measures or 'H' in frame_measures):
-                continue
-
-            self.frame_index = i
-            frame = self.pixel_data[i] if self.pixel_data.ndim == 3 else self.pixel_data
-
-            fig = Figure(figsize=(6, 6), dpi=150)
-            canvas = FigureCanvas(fig)
-            ax = fig.add_subplot(111)
-            ax.imshow(frame, cmap='gray', aspect='equal', extent=[0, frame.shape[1], frame.shape[0], 0])
-            ax.axis('off')
-
-            if i in self.bone_lines:
-                p1, p2 = self.bone_lines[i]
-                ax.plot([p1[0], p2[0]], [p1[1], p2[1]], linestyle='dashed', color='cyan', linewidth=0.8)
-
-            for key, color, offset_dir in [('h', 'red', -1), ('H', 'yellow', 1)]:
-                if key in frame_measures:
-                    p1, p2 = frame_measures[key]
-                    bone = self.bone_lines.get(i)
-                    if bone:
-                        (x1, y1), (x2, y2) = bone
-                        dx, dy = x2 - x1, y2 - y1
-                        if dx == dy == 0:
-                            offset_x = offset_y = 0
-                        else:
-                            normal_x, normal_y = -dy, dx
-                            length = (normal_x ** 2 + normal_y ** 2) ** 0.5
-                            normal_x /= length
-                            normal_y /= length
-                            offset_amount = 5
-                            offset_x = normal_x * offset_amount * offset_dir
-                            offset_y = normal_y * offset_amount * offset_dir
-                    else:
-                        offset_x = offset_y = 0
+        def cancel():
+            nonlocal cancelled
+            cancelled = True
+            pending.clear()
+            for future in running:
+                future.cancel()                             # frames already rendering are left to finish
+            progress_label.config(text="Cancelling...")
 
-                    p1o = (p1[0] + offset_x, p1[1] + offset_y)
-                    p2o = (p2[0] + offset_x, p2[1] + offset_y)
+        progress_win.protocol("WM_DELETE_WINDOW", cancel)
 
-                    ax.plot([p1o[0], p2o[0]], [p1o[1], p2o[1]], color=color, linewidth=0.8)
-                    ax.plot(p1o[0], p1o[1], marker='o', markersize=0.5, color=color)
-                    ax.plot(p2o[0], p2o[1], marker='o', markersize=0.5, color=color)
+        def submit_more():
+            # Keep only a couple of frames per worker in flight, so pixels aren't all copied at once
+            while pending and len(running) < 2 * workers:
+                try:
+                    func, *args = make_job(pending.pop(0))
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                running.add(executor.submit(func, *args))
+
+        def poll():
+            nonlocal saved_count
+            for future in [f for f in running if f.done()]:
+                running.discard(future)
+                if future.cancelled():
+                    continue
+                saved_count += 1
+                if future.exception() is not None:
+                    errors.append(future.exception())
+            window_open = progress_win.winfo_exists()
+            if window_open and not cancelled:
+                progress_bar['value'] = saved_count
+                progress_label.config(text=f"Saving images {saved_count} / {len(items)}")
+
+            if pending or running:
+                submit_more()
+                self.root.after(50, poll)
+                return
 
-            out_path = os.path.join(base_folder, f"frame_{i + 1:03d}.png")
-            fig.savefig(out_path, bbox_inches='tight', pad_inches=0)
-            plt.close(fig)
-            saved_count += 1
+            executor.shutdown(wait=False)
+            if window_open:
+                progress_win.destroy()
+            if cancelled:
+                errors.insert(0, RuntimeError(f"Cancelled after {saved_count} of {len(items)} images"))
+            if on_done:
+                on_done(errors[0] if errors else None)
+            self.focus_app_window()
 
-        self.frame_index = original_index
-        self.show_frame()
-        self.focus_app_window()
+        submit_more()
+        poll()
 
 
     def copy_measurements_to_range(self):
@@ -1317,6 +1514,7 @@ class DICOMViewer:
             if source_slope is not None:
                 self.bone_slope[i] = source_slope
                 
+        self.journal_frames(range(start, end + 1))
         messagebox.showinfo("Success", f"Measurements copied to frames {start+1} to {end+1}.")
         self.focus_app_window()
 
@@ -1328,9 +1526,18 @@ class DICOMViewer:
             self.root.after_cancel(self.resize_after_id)
         self.resize_after_id = self.root.after(200, self.show_frame)
 
+    # RENDER SCHEDULER (sliders and panning fire many events per frame, only the latest state is drawn)
+    def request_render(self):
+        if self.render_after_id is None:
+            self.render_after_id = self.root.after(self.render_interval, self.run_scheduled_render)
+
+    def run_scheduled_render(self):
+        self.render_after_id = None
+        self.show_frame()
+
     def on_zoom_change(self, val):
         self.zoom_level = int(val)
-        self.show_frame()
+        self.request_render()
 
     def reset_zoom(self):
         self.zoom_level = 0
@@ -1339,10 +1546,8 @@ class DICOMViewer:
         self.show_frame()
 
     # WINDOW LEVELLING
-    def apply_window_level(self, frame):
-        wc = self.window_center
-        ww = self.window_width
-        frame = frame.astype(np.float32)
+    def window_level_values(self, values, wc, ww):
+        values = values.astype(np.float32)
 
         # Prevent divide by zero
         if ww < 1:
@@ -1351,17 +1556,40 @@ class DICOMViewer:
         lower = wc - ww / 2
         upper = wc + ww / 2
 
-        frame = np.clip(frame, lower, upper)
-        frame = (frame - lower) / (upper - lower) * 255.0
-        return frame.astype(np.uint8)
-    
+        values = np.clip(values, lower, upper)
+        values = (values - lower) / (upper - lower) * 255.0
+        return values.astype(np.uint8)
+
+    def get_window_lut(self, dtype, wc, ww):
+        # uint8 lookup table covering every value of an 8/16-bit integer dtype, indexed by the unsigned bit pattern
+        key = (dtype.str, wc, ww)
+        lut = self.window_luts.get(key)
+        if lut is None:
+            index_dtype = dtype.newbyteorder('=')
+            all_values = np.arange(2 ** (8 * dtype.itemsize), dtype=f"u{dtype.itemsize}").view(index_dtype)
+            lut = self.window_level_values(all_values, wc, ww)
+            if len(self.window_luts) >= 8:
+                self.window_luts.clear()
+            self.window_luts[key] = lut
+        return lut
+
+    def apply_window_level(self, frame, wc=None, ww=None):
+        wc = self.window_center if wc is None else wc
+        ww = self.window_width if ww is None else ww
+
+        # Integer frames go through a lookup table: one indexing pass, no float32 copy of the frame
+        if frame.dtype.kind in 'iu' and frame.dtype.itemsize <= 2:
+            lut = self.get_window_lut(frame.dtype, wc, ww)
+            return lut[frame.view(frame.dtype.str.replace('i', 'u'))]
+        return self.window_level_values(frame, wc, ww)
+
     def update_window_center(self, val):
         self.window_center = int(val)
-        self.show_frame()
+        self.request_render()
 
     def update_window_width(self, val):
         self.window_width = int(val)
-        self.show_frame()
+        self.request_render()
 
     def reset_window_level(self):
         if self.original_window_center is not None and self.original_window_width is not None:
@@ -1372,9 +1600,8 @@ class DICOMViewer:
             self.show_frame()
 
     def initialize_window_level_from_pixel_data(self):
-        # Estimate initial WC/WW from data
-        pixel_min = np.min(self.pixel_data)
-        pixel_max = np.max(self.pixel_data)
+        # Estimate initial WC/WW from a few sampled frames (avoids decoding every frame)
+        pixel_min, pixel_max = self.frames.sample_range()
         self.original_window_center = (pixel_max + pixel_min) // 2
         self.original_window_width = pixel_max - pixel_min
         self.window_center = self.original_window_center
@@ -1387,6 +1614,92 @@ class DICOMViewer:
         self.ww_slider.set(self.window_width)
 
 
+    def working_state(self):
+        # Snapshot of everything a working file stores (copies, so it can be written from another thread)
+        dicom_path = getattr(self.dicom, "filename", None)
+        return {
+            "dicom_path": dicom_path,                                             # May be None
+            "dicom_filename": os.path.basename(dicom_path) if dicom_path else None,  # Just the file name
+            "sop_instance_uid": str(getattr(self.dicom, "SOPInstanceUID", "")) or None,
+            "pixel_spacing": list(self.pixel_spacing),
+            **self.store_snapshot(),
+            "frame_index": self.frame_index,
+            "zoom_level": self.zoom_level,
+            "pan_offset": list(self.pan_offset),
+            "window_center": self.window_center,
+            "window_width": self.window_width,
+            "original_window_center": self.original_window_center,
+            "original_window_width": self.original_window_width,
+            "frame_joint_labels": dict(getattr(self, "frame_joint_labels", {}))
+        }
+
+    def store_snapshot(self):
+        # measurements / bone_lines / bone_slope of a copy of the store (one array copy instead of nested dicts)
+        snapshot = self.store.copy()
+        return {"measurements": snapshot.measurements, "bone_lines": snapshot.bone_lines, "bone_slope": snapshot.bone_slope}
+
+    # AUTOSAVE JOURNAL
+    def start_journal(self, dicom_path, base_state=None, base_path=None):
+        # Offer to recover edits a previous session on the same DICOM and working file (base_path, None for a
+        # bare DICOM) left in its journal, then start journaling this one
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+        recovered = None
+        try:
+            recovered = working_file.recover_session(dicom_path, base_path, base_state)
+        except Exception as e:
+            print(f"Warning: could not read autosave journal: {e}")
+
+        try:
+            self.journal = working_file.SessionJournal(dicom_path, base_path)
+        except Exception as e:
+            print(f"Warning: autosave disabled: {e}")
+            return
+
+        if recovered is not None:
+            session_id, state = recovered
+            if messagebox.askyesno("Recover", "Unsaved measurements from a previous session were found for this DICOM.\nRecover them?"):
+                self.store.load(state.get("measurements", {}), state.get("bone_lines", {}),
+                                state.get("bone_slope", {}), self.num_frames)
+                self.frame_joint_labels = state.get("frame_joint_labels", {})
+                self.journal.take_over(dicom_path, session_id, self.working_state())
+            else:
+                try:
+                    working_file.remove_session(dicom_path, session_id)
+                except OSError as e:
+                    print(f"Warning: could not remove autosave journal: {e}")
+
+    def journal_frames(self, frames):
+        # Record the current measurements/bone line of each frame (called after every completed edit)
+        if self.journal is None:
+            return
+        records = [working_file.frame_record(f, self.measurements, self.bone_lines, self.bone_slope) for f in frames]
+        self.journal.append(records, self.working_state)
+
+    def journal_labels(self, labels=None):
+        # labels: {frame: joint} that changed, or None when all labels were cleared
+        if self.journal is None:
+            return
+        if labels is None:
+            record = {"type": "clear_labels"}
+        else:
+            record = {"type": "labels", "labels": {str(frame): joint for frame, joint in labels.items()}}
+        self.journal.append([record], self.working_state)
+
+    def on_app_close(self):
+        # Flush the journal and release background decoding before exiting
+        if self.journal is not None:
+            self.journal.close()
+        self.header_cache.save()
+        self.save_executor.shutdown(wait=True)      # let pending working file saves finish
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        if self.frames is not None:
+            self.frames.close()
+        self.root.destroy()
+
     def save_working_file(self):
         if not self.dicom:
             messagebox.showinfo("No DICOM", "Load a DICOM file first.")
@@ -1409,29 +1722,41 @@ class DICOMViewer:
         if not save_path:
             return
 
-        try:
-            data = {
-                "dicom_path": getattr(self.dicom, "filename", None),  # May be None
-                "dicom_filename": dicom_filename_only,                # Just the file name
-                "measurements": self.measurements,
-                "bone_lines": self.bone_lines,
-                "bone_slope": self.bone_slope,
-                "frame_index": self.frame_index,
-                "zoom_level": self.zoom_level,
-                "pan_offset": self.pan_offset,
-                "window_center": self.window_center,
-                "window_width": self.window_width,
-                "original_window_center": self.original_window_center,
-                "original_window_width": self.original_window_width,
-                "frame_joint_labels": getattr(self, "frame_joint_labels", {})
-            }
-            with open(save_path, "wb") as f:
-                pickle.dump(data, f)
+        # Snapshot the state now, the file is written on the save thread while annotation continues
+        journal = self.journal
+        journal_position = journal.total_records if journal is not None else None
+        dicom = self.dicom
+
+        def on_saved(error):
+            if error is not None:
+                messagebox.showerror("Error", f"Failed to save working file:\n{error}")
+                return
+            # Everything is in the saved working file now, unless edits were made while saving or
+            # another DICOM (with its own journal) was loaded meanwhile
+            if journal is not None and self.journal is journal and journal.total_records == journal_position:
+                journal.discard()
+            if journal is not None and self.journal is journal:
+                journal.set_base(save_path)             # a crash from now on recovers onto the file just saved
+            if self.dicom is dicom:
+                self.current_working_file = save_path   # later label edits go to the file just saved
             messagebox.showinfo("Saved", f"Working file saved to:\n{save_path}")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save working file:\n{e}")
+            self.focus_app_window()
+
+        self.run_in_background(working_file.save_state, (save_path, self.working_state()), on_saved)
         self.focus_app_window()
 
+    def run_in_background(self, func, args, on_done):
+        # Run func(*args) on the save thread; on_done(error or None) is called back on the Tk thread
+        future = self.save_executor.submit(func, *args)
+
+        def poll():
+            if not future.done():
+                self.root.after(50, poll)
+                return
+            on_done(future.exception())
+
+        poll()
+
     def load_working_file(self):
         filepath = filedialog.askopenfilename(
             filetypes=[("DICOM Working File", "*.dcmstate")],
@@ -1440,11 +1765,8 @@ class DICOMViewer:
         if not filepath:
             return
 
-        self.current_working_file = filepath  # Save loaded working file path
-
         try:
-            with open(filepath, "rb") as f:
-                data = pickle.load(f)
+            data = working_file.load_state(filepath)   # also reads older pickle-based working files
 
             dicom_path = data.get("dicom_path")
             dicom_filename = data.get("dicom_filename")
@@ -1476,15 +1798,14 @@ class DICOMViewer:
                     return
 
             # Load DICOM
-            self.dicom = pydicom.dcmread(dicom_path)
-            self.pixel_data = self.dicom.pixel_array
+            self.dicom = pydicom.dcmread(dicom_path, defer_size='1 MB')
+            self.set_frames(self.dicom)
             self.pixel_spacing = [float(sp) for sp in getattr(self.dicom, 'PixelSpacing', [1.0, 1.0])]
-            self.num_frames = self.pixel_data.shape[0] if self.pixel_data.ndim == 3 else 1
+            self.header_cache.remember(dicom_path, self.dicom)
 
             # Restore state
-            self.measurements = data.get("measurements", {})
-            self.bone_lines = data.get("bone_lines", {})
-            self.bone_slope = data.get("bone_slope", {})
+            self.store.load(data.get("measurements", {}), data.get("bone_lines", {}), data.get("bone_slope", {}),
+                            self.num_frames)
             self.frame_index = data.get("frame_index", 0)
             self.zoom_level = data.get("zoom_level", 0)
             self.zoom_slider.set(self.zoom_level)
@@ -1501,6 +1822,11 @@ class DICOMViewer:
 
             # Restore joint labels
             self.frame_joint_labels = data.get("frame_joint_labels", {})
+            self.start_journal(dicom_path, base_state=data, base_path=filepath)
+
+            # Labels edited later are written back to this file; older pickle files are left alone (they
+            # would be rewritten in the new format) and keep their labels through the journal and Save
+            self.current_working_file = None if working_file.is_legacy_file(filepath) else filepath
             
             # Display working file name (includes date)
             working_filename = os.path.basename(filepath)
@@ -1560,15 +1886,15 @@ class DICOMViewer:
             tree.column(col, anchor="center", width=100)
 
         # Populate rows from measurements with alternating batch colors
-        sorted_frames = sorted(self.measurements.keys())
+        # (h and H of every measured frame in one call, NaN where missing)
+        sorted_frames, h_lengths, H_lengths = self.store.lengths_mm(self.pixel_spacing)
 
         batch_index = 0  # 0 = white, 1 = grey
         last_frame = None
 
-        for frame_num in sorted_frames:
-            frame_data = self.measurements[frame_num]
-            h_val = round(self.calculate_distance(*frame_data['h']), 2) if 'h' in frame_data else None
-            H_val = round(self.calculate_distance(*frame_data['H']), 2) if 'H' in frame_data else None
+        for frame_num, h_len, H_len in zip(sorted_frames.tolist(), h_lengths.tolist(), H_lengths.tolist()):
+            h_val = None if math.isnan(h_len) else round(h_len, 2)
+            H_val = None if math.isnan(H_len) else round(H_len, 2)
             or_ratio = round(h_val / H_val * 100, 1) if h_val and H_val else None
 
             current_label = self.frame_joint_labels.get(frame_num, "")
@@ -1623,10 +1949,12 @@ class DICOMViewer:
                 count_in_group = 0
 
                 # Bulk label frames in groups of 3
+                changed = {}
                 for i in range(start_pos, len(frames_sorted)):
                     frame = frames_sorted[i]
                     tree.set(tree.get_children()[i], "Joint", joint_names[joint_index])
                     self.frame_joint_labels[frame] = joint_names[joint_index]
+                    changed[frame] = joint_names[joint_index]
 
                     count_in_group += 1
                     if count_in_group == 3:
@@ -1634,6 +1962,7 @@ class DICOMViewer:
                         joint_index += 1
                         if joint_index >= len(joint_names):
                             break
+                self.journal_labels(changed)
 
                 tree.unbind("<Button-1>", tree_click_id)
                 info_label.destroy()
@@ -1687,6 +2016,7 @@ class DICOMViewer:
                 # Convert displayed frame number (1-based) back to 0-based index
                 frame_val = int(tree.set(row_id, "Frame")) - 1
                 self.frame_joint_labels[frame_val] = new_val  # overwrite cleanly
+                self.journal_labels({frame_val: new_val})
 
                 combo.place_forget()
                 tree.focus_set()  # return focus to tree for next click
@@ -1695,16 +2025,14 @@ class DICOMViewer:
             combo.bind("<FocusOut>", lambda e: (combo.place_forget(), tree.focus_set()))
             
             def on_close():
-                # Persist labels back to the current state file
-                if hasattr(self, "current_state_file"):
-                    try:
-                        with open(self.current_state_file, "rb") as f:
-                            data = pickle.load(f)
-                        data["frame_joint_labels"] = self.frame_joint_labels
-                        with open(self.current_state_file, "wb") as f:
-                            pickle.dump(data, f)
-                    except Exception as e:
-                        print("Warning: could not save labels:", e)
+                # Persist labels back to the loaded working file (written on the save thread)
+                if self.current_working_file:
+                    def on_saved(error):
+                        if error is not None:
+                            print("Warning: could not save labels:", error)
+
+                    self.run_in_background(working_file.update_labels,
+                                           (self.current_working_file, dict(self.frame_joint_labels)), on_saved)
                 win.destroy()
 
             win.protocol("WM_DELETE_WINDOW", on_close)
@@ -1717,6 +2045,7 @@ class DICOMViewer:
                 tree.set(row_id, "Joint", "")
             # Clear the stored labels in the working file
             self.frame_joint_labels = {}
+            self.journal_labels(None)
 
         # Button to clear all joint labels
         clear_button = tk.Button(win, text="Clear All Labels", command=clear_all_labels)
@@ -0,0 +1,118 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import dicom_header_cache
+import measurement_export
+import working_file
+
+
+# Headless export of every working file under a folder into one consolidated table, without the viewer:
+#
+#   python batch_export.py STUDIES_FOLDER -o cohort.xlsx        (or .csv / .parquet)
+#
+# The measurements are read and converted to h / H / OR / click columns on a process pool, with the same
+# math as the viewer's Export button. Spacing comes from the DICOM header cache.
+
+
+def find_working_files(folder):
+    # Every .dcmstate under folder, sorted, skipping autosave snapshots and half-written temp files
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".dcmstate") and not name.endswith(".autosave.dcmstate") and not name.startswith("."):
+                paths.append(os.path.join(root, name))
+    return paths
+
+
+def resolve_dicom_path(state_path, header):
+    # Same order as DICOMViewer.load_working_file: the saved path, then the working file's folder
+    dicom_path = header.get("dicom_path")
+    if dicom_path and os.path.exists(dicom_path):
+        return dicom_path
+    dicom_filename = header.get("dicom_filename")
+    if dicom_filename:
+        possible_path = os.path.join(os.path.dirname(state_path), dicom_filename)
+        if os.path.exists(possible_path):
+            return possible_path
+    return None
+
+
+def resolve_spacing(state_path, header, cache):
+    # (pixel spacing [row, col], dicom filename, warning or None)
+    dicom_path = resolve_dicom_path(state_path, header)
+    dicom_filename = os.path.basename(dicom_path) if dicom_path else (header.get("dicom_filename") or "Unknown")
+    spacing = cache.spacing(dicom_path) if dicom_path else None
+    if spacing:
+        return list(spacing), dicom_filename, None
+
+    # fall back to whatever was stored in the working file
+    stored = header.get("pixel_spacing")
+    if stored and len(stored) >= 2:
+        return [float(stored[0]), float(stored[1])], dicom_filename, "DICOM not found, using the spacing saved in the working file"
+    return [1.0, 1.0], dicom_filename, "DICOM and spacing not found, using 1.0 mm"
+
+
+def working_file_columns(state_path, source, dicom_filename, pixel_spacing):
+    # Worker: one working file's measurements as export columns, tagged with source (see export_folder)
+    measurements = working_file.load_state(state_path, sections=("measurements",)).get("measurements", {})
+    columns = measurement_export.measurement_columns(dicom_filename, measurements, pixel_spacing)
+    columns[measurement_export.SOURCE_COLUMN[0]] = np.full(len(columns["Frame"]), source, dtype=object)
+    return columns
+
+
+def export_folder(folder, output_path, workers=None, cache=None, log=print):
+    cache = cache or dicom_header_cache.HeaderCache()
+    jobs = []
+    for state_path in find_working_files(folder):
+        try:
+            header = working_file.load_header(state_path)
+        except Exception as e:
+            log(f"Skipping {state_path}: {e}")
+            continue
+        pixel_spacing, dicom_filename, warning = resolve_spacing(state_path, header, cache)
+        if warning:
+            log(f"{state_path}: {warning}")
+        # rows are tagged with the working file's path below folder, so raters, sessions and same-named
+        # DICOMs in different folders stay apart
+        source = os.path.relpath(state_path, folder)
+        jobs.append((state_path, source, dicom_filename, pixel_spacing))
+    cache.save()
+
+    column_sets = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(working_file_columns, *job) for job in jobs]
+        for (state_path, *_), future in zip(jobs, futures):
+            try:
+                column_sets.append(future.result())
+            except Exception as e:
+                log(f"Skipping {state_path}: {e}")
+
+    columns = measurement_export.concat_columns(column_sets, measurement_export.BATCH_COLUMNS)
+    measurement_export.write_columns(output_path, columns, measurement_export.BATCH_COLUMNS)
+    log(f"Exported {len(columns['Frame'])} rows from {len(column_sets)} working files to {output_path}")
+    return columns
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the measurements of every .dcmstate file in a folder tree.")
+    parser.add_argument("folder", help="folder searched recursively for .dcmstate working files")
+    parser.add_argument("-o", "--output", default="measurements.xlsx",
+                        help="output file, .xlsx, .csv or .parquet (default: measurements.xlsx)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.folder):
+        parser.error(f"{args.folder} is not a folder")
+    try:
+        export_folder(args.folder, args.output, workers=args.workers)
+    except Exception as e:
+        print(f"Failed to export measurements: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+import threading
+import pydicom
+import working_file
+
+
+# Persistent cache of the DICOM header fields the measurement tools need (spacing and geometry), so
+# comparisons and exports don't re-parse the same files. Entries are keyed by absolute path and only
+# trusted while the file's size and modification time are unchanged.
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".hand_bone_measurements", "header_cache.json")
+CACHE_VERSION = 1
+
+
+def header_from_dataset(data_set):
+    spacing = getattr(data_set, "PixelSpacing", None)
+    return {
+        "pixel_spacing": [float(spacing[0]), float(spacing[1])] if spacing is not None and len(spacing) >= 2 else None,
+        "rows": int(getattr(data_set, "Rows", 0) or 0),
+        "columns": int(getattr(data_set, "Columns", 0) or 0),
+        "number_of_frames": int(getattr(data_set, "NumberOfFrames", 1) or 1),
+        "sop_instance_uid": str(getattr(data_set, "SOPInstanceUID", "")),
+    }
+
+
+class HeaderCache:
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH):
+        self.cache_path = cache_path
+        self.entries = None                     # {absolute path: header dict + size/mtime_ns}, read on first use
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(dicom_path):
+        return os.path.normcase(os.path.abspath(dicom_path))
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                self.entries = data.get("entries", {})
+        except (OSError, ValueError):
+            pass                                # missing or unreadable cache, start empty
+
+    def lookup(self, dicom_path):
+        # Header dict for dicom_path, read from the file only if it isn't cached or the file changed.
+        # Returns None if the file is missing or not a readable DICOM.
+        try:
+            stat = os.stat(dicom_path)
+        except OSError:
+            return None
+        with self.lock:
+            self.load()
+            entry = self.entries.get(self.key(dicom_path))
+            if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                return entry
+
+        try:
+            data_set = pydicom.dcmread(dicom_path, stop_before_pixels=True)
+        except Exception:
+            return None
+        return self.store(dicom_path, stat, header_from_dataset(data_set))
+
+    def remember(self, dicom_path, data_set):
+        # Record the header of a dataset that was opened anyway (e.g. loaded into the viewer)
+        try:
+            stat = os.stat(dicom_path)
+        except OSError:
+            return None
+        return self.store(dicom_path, stat, header_from_dataset(data_set))
+
+    def store(self, dicom_path, stat, header):
+        entry = dict(header, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        with self.lock:
+            self.load()
+            if self.entries.get(self.key(dicom_path)) != entry:
+                self.entries[self.key(dicom_path)] = entry
+                self.dirty = True
+        return entry
+
+    def spacing(self, dicom_path):
+        # (row spacing, column spacing) in mm, or None if unknown
+        entry = self.lookup(dicom_path)
+        if entry and entry["pixel_spacing"]:
+            return tuple(entry["pixel_spacing"])
+        return None
+
+    def save(self):
+        # Written to a temp file and renamed, so a reader never sees a half-written cache
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps({"version": CACHE_VERSION, "entries": self.entries})
+            self.dirty = False
+        folder = os.path.dirname(self.cache_path)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".json.tmp", dir=folder)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            working_file.copy_file_mode(temp_path, self.cache_path)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass                                # the cache is only an optimisation
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+# Geometry of the measurements, batched: points are (..., 2) arrays of (x, y) image coordinates and lines or
+# segments are given by their two end points, broadcasting against each other. Single points/tuples work too,
+# the results then come back as 0-d arrays / single points.
+
+# side of the bone line each measurement is drawn on (h below, H above), see offset_segments
+OFFSET_DIRECTIONS = {'h': -1, 'H': 1}
+
+# how far (image pixels) h and H are drawn from the bone line; drawing, hit-testing and exported images all use it
+VISUAL_OFFSET = 8
+
+
+def project_points(points, line_p1, line_p2):
+    # Perpendicular projection of points onto the (infinite) lines through line_p1 and line_p2
+    points, line_p1, line_p2 = (np.asarray(a, dtype=np.float64) for a in (points, line_p1, line_p2))
+    # A zero-length line (both bone clicks on the same pixel) projects everything onto line_p1.
+    direction = line_p2 - line_p1
+    length_sq = (direction * direction).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scalar_proj = np.where(length_sq == 0, 0.0, ((points - line_p1) * direction).sum(axis=-1) / length_sq)
+    return line_p1 + scalar_proj[..., None] * direction
+
+
+def distances_mm(p1, p2, pixel_spacing):
+    # Distance in mm between p1 and p2; pixel_spacing is [row spacing, column spacing] (y, x) in mm
+    delta = np.asarray(p2, dtype=np.float64) - np.asarray(p1, dtype=np.float64)
+    return np.hypot(delta[..., 0] * pixel_spacing[1], delta[..., 1] * pixel_spacing[0])
+
+
+def segment_lengths_mm(segments, pixel_spacing):
+    # segments: (n, 2, 2) array of ((x1, y1), (x2, y2))
+    segments = np.asarray(segments, dtype=np.float64)
+    return distances_mm(segments[..., 0, :], segments[..., 1, :], pixel_spacing)
+
+
+def unit_normals(line_p1, line_p2):
+    # Unit vectors perpendicular to the lines ((-dy, dx) normalised), zero for degenerate lines
+    direction = np.asarray(line_p2, dtype=np.float64) - np.asarray(line_p1, dtype=np.float64)
+    normals = np.stack([-direction[..., 1], direction[..., 0]], axis=-1)
+    length = np.hypot(normals[..., 0], normals[..., 1])[..., None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(length > 0, normals / length, 0.0)
+
+
+def offset_segments(segments, bone_line, amounts):
+    # Shift segments (..., 2, 2) along the bone line's normal by amounts (signed, broadcasting with the
+    # segments' leading axes). Used to draw h and H beside the bone line instead of on it.
+    segments = np.asarray(segments, dtype=np.float64)
+    if bone_line is None:
+        return segments
+    bone_line = np.asarray(bone_line, dtype=np.float64)
+    normal = unit_normals(bone_line[..., 0, :], bone_line[..., 1, :])
+    shift = normal * np.asarray(amounts, dtype=np.float64)[..., None]
+    return segments + shift[..., None, :]
+
+
+def measurement_segments(frame_measures, bone_line, offset_amount):
+    # {key: ((x1, y1), (x2, y2))} of h and H as drawn, offset to their side of the bone line
+    keys = [key for key in OFFSET_DIRECTIONS if key in frame_measures]
+    if not keys:
+        return {}
+    segments = offset_segments([frame_measures[key] for key in keys], bone_line,
+                               [OFFSET_DIRECTIONS[key] * offset_amount for key in keys])
+    return {key: tuple(map(tuple, segment.tolist())) for key, segment in zip(keys, segments)}
+
+
+def point_distances(points, targets):
+    delta = np.asarray(points, dtype=np.float64) - np.asarray(targets, dtype=np.float64)
+    return np.hypot(delta[..., 0], delta[..., 1])
+
+
+def segment_distances(points, seg_p1, seg_p2):
+    # Distance from points to the closest point of the segments (end points for degenerate segments)
+    points, seg_p1, seg_p2 = (np.asarray(a, dtype=np.float64) for a in (points, seg_p1, seg_p2))
+    direction = seg_p2 - seg_p1
+    length_sq = (direction * direction).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(length_sq > 0, ((points - seg_p1) * direction).sum(axis=-1) / length_sq, 0.0)
+    closest = seg_p1 + np.clip(t, 0.0, 1.0)[..., None] * direction
+    return point_distances(points, closest)
@@ -0,0 +1,123 @@
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+import geometry
+
+
+# Annotated frame images for export. Everything here runs in worker processes, so the functions
+# only take plain data: the frame's pixels and its overlay geometry. The overlays are drawn straight
+# onto a uint8 raster with Pillow instead of going through a matplotlib figure per PNG.
+
+# colour of each measurement
+MEASUREMENT_COLORS = {'h': 'red', 'H': 'yellow'}
+
+# raw click colours for file 1 and file 2 in the comparison images
+CLICK_COLORS = (['cyan', 'springgreen', 'dodgerblue'], ['blueviolet', 'deeppink', 'lightpink'])
+
+# exported images are upscaled (nearest neighbour) until the long side reaches about this many pixels
+EXPORT_SIZE = 700
+
+
+def measurement_overlays(frame_measures, bone_line):
+    # [(p1, p2, color)] for h and H, shifted along the bone line's normal by the viewer's on-screen offset
+    segments = geometry.measurement_segments(frame_measures, bone_line, geometry.VISUAL_OFFSET)
+    return [(p1o, p2o, MEASUREMENT_COLORS[key]) for key, (p1o, p2o) in segments.items()]
+
+
+def export_scale(frame):
+    return max(1, int(round(EXPORT_SIZE / max(frame.shape[:2]))))
+
+
+def frame_to_image(frame, scale=1):
+    # Grayscale frame -> RGB image stretched over its own min..max (like imshow's default normalisation)
+    frame = np.asarray(frame)
+    lo, hi = float(frame.min()), float(frame.max())
+    if hi > lo:
+        gray = ((frame.astype(np.float32) - lo) * (255.0 / (hi - lo))).astype(np.uint8)
+    else:
+        gray = np.zeros(frame.shape, dtype=np.uint8)
+    if scale > 1:
+        gray = np.repeat(np.repeat(gray, scale, axis=0), scale, axis=1)
+    return Image.fromarray(gray, mode='L').convert('RGB')
+
+
+def to_canvas(point, scale):
+    # Image coordinates (pixel i covers i..i+1, as in the viewer's extent) -> Pillow pixel coordinates
+    return (point[0] * scale - 0.5, point[1] * scale - 0.5)
+
+
+def draw_dashed_line(draw, p1, p2, color, width=1, dash=6, gap=4):
+    (x1, y1), (x2, y2) = p1, p2
+    length = ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5
+    if length == 0:
+        return
+    starts = np.arange(0, length, dash + gap)
+    ends = np.minimum(starts + dash, length)
+    ux, uy = (x2 - x1) / length, (y2 - y1) / length
+    for s, e in zip(starts, ends):
+        draw.line([(x1 + ux * s, y1 + uy * s), (x1 + ux * e, y1 + uy * e)], fill=color, width=width)
+
+
+def draw_dot(draw, center, color, radius=1):
+    x, y = center
+    draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=color)
+
+
+def draw_cross(draw, center, color, size=3, width=1):
+    x, y = center
+    draw.line([(x - size, y - size), (x + size, y + size)], fill=color, width=width)
+    draw.line([(x - size, y + size), (x + size, y - size)], fill=color, width=width)
+
+
+def render_measurement_image(out_path, frame, bone_line, overlays):
+    scale = export_scale(frame)
+    image = frame_to_image(frame, scale)
+    draw = ImageDraw.Draw(image)
+
+    if bone_line:
+        p1, p2 = bone_line
+        draw_dashed_line(draw, to_canvas(p1, scale), to_canvas(p2, scale), 'cyan')
+
+    for p1o, p2o, color in overlays:
+        c1, c2 = to_canvas(p1o, scale), to_canvas(p2o, scale)
+        draw.line([c1, c2], fill=color, width=1)
+        draw_dot(draw, c1, color)
+        draw_dot(draw, c2, color)
+
+    image.save(out_path, compress_level=1)   # fast zlib setting; export time is dominated by compression otherwise
+    return out_path
+
+
+def render_click_comparison_image(out_path, frame, clicks1, clicks2):
+    # Raw clicks of two raters as crosses on the frame, with a legend in the top right corner
+    scale = export_scale(frame)
+    image = frame_to_image(frame, scale).convert('RGBA')
+    layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+
+    legend = []
+    for file_number, (clicks, colors) in enumerate(zip((clicks1, clicks2), CLICK_COLORS), start=1):
+        for k, p in enumerate(clicks or ()):
+            if p is not None:
+                draw_cross(draw, to_canvas(p, scale), colors[k])
+                legend.append((f'File {file_number} Click {k+1}', colors[k]))
+
+    if legend:
+        row_height = 12
+        box_width = 100
+        left = image.size[0] - box_width - 4
+        draw.rectangle([left, 4, left + box_width, 8 + row_height * len(legend)], fill=(255, 255, 255, 128))
+        for row, (text, color) in enumerate(legend):
+            y = 6 + row * row_height + row_height // 2
+            draw_cross(draw, (left + 8, y), color)
+            draw.text((left + 16, y - 5), text, fill='black')
+
+    # crosses and legend are drawn slightly transparent
+    alpha = layer.getchannel('A').point(lambda a: a * 0.8)
+    layer.putalpha(alpha)
+    Image.alpha_composite(image, layer).convert('RGB').save(out_path, compress_level=1)
+    return out_path
+
+
+def frame_image_path(base_folder, frame_index):
+    return os.path.join(base_folder, f"frame_{frame_index + 1:03d}.png")
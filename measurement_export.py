@@ -0,0 +1,133 @@
+import csv
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle
+import geometry
+import working_file
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:       # Parquet export is optional
+    pyarrow = None
+
+
+# Measurement export in a columnar layout: every backend (Excel, CSV, Parquet) writes the same columns,
+# computed for all frames at once from the array-backed measurement records.
+
+# (column name, type) in output order
+COLUMNS = [
+    ("Filename", "string"),
+    ("Frame", "int32"),
+    ("h (mm)", "float64"),
+    ("H (mm)", "float64"),
+    ("OR (%)", "float64"),
+    ("Click 1 x", "float64"), ("Click 1 y", "float64"),
+    ("Click 2 x", "float64"), ("Click 2 y", "float64"),
+    ("Click 3 x", "float64"), ("Click 3 y", "float64"),
+]
+
+# batch exports put several working files in one table; this column tells their rows apart
+SOURCE_COLUMN = ("Working File", "string")
+BATCH_COLUMNS = [SOURCE_COLUMN] + COLUMNS
+
+FILE_TYPES = [("Excel files", "*.xlsx"), ("CSV files (typed header)", "*.csv")]
+if pyarrow is not None:
+    FILE_TYPES.append(("Parquet files", "*.parquet"))
+
+
+def measurement_columns(filename, measurements, pixel_spacing):
+    # {column name: array} for every measured frame, sorted by frame. Missing values are NaN.
+    records = working_file.measurements_to_array(measurements)
+
+    h_mm = np.round(geometry.segment_lengths_mm(records["h"], pixel_spacing), 2)
+    H_mm = np.round(geometry.segment_lengths_mm(records["H"], pixel_spacing), 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        or_ratio = np.where(H_mm != 0, np.round(h_mm / H_mm * 100, 1), np.nan)
+
+    clicks_mm = records["raw_clicks"] * [pixel_spacing[1], pixel_spacing[0]]   # (n, 3, 2) x in mm, y in mm
+    clicks_mm = np.round(clicks_mm.reshape(len(records), 6), 2)
+
+    columns = {
+        "Filename": np.full(len(records), filename, dtype=object),
+        "Frame": records["frame"] + 1,
+        "h (mm)": h_mm,
+        "H (mm)": H_mm,
+        "OR (%)": or_ratio,
+    }
+    for k, (name, _) in enumerate(COLUMNS[5:]):
+        columns[name] = clicks_mm[:, k]
+    return columns
+
+
+def concat_columns(column_sets, column_types=COLUMNS):
+    # Stack the columns of several studies into one table
+    return {name: np.concatenate([cols[name] for cols in column_sets]) if column_sets else np.array([])
+            for name, _ in column_types}
+
+
+def write_xlsx(path, columns, sheet_title="Measurements", column_types=COLUMNS):
+    # Write-only workbook: rows are streamed to the file instead of kept as a grid of cell objects
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_title)
+    names = [name for name, _ in column_types]
+    numeric = [kind == "float64" for _, kind in column_types]
+    ws.append(names)
+
+    # Number style built once and shared by every numeric cell
+    two_decimals = NamedStyle(name="two_decimals", number_format="0.00")
+    wb.add_named_style(two_decimals)
+
+    def number_cell(value):
+        """Float with 2 decimal places, stored as a number in Excel (blank if missing)."""
+        if value is None or np.isnan(value):
+            return None
+        cell = WriteOnlyCell(ws, value=round(float(value), 2))
+        cell.style = two_decimals.name
+        return cell
+
+    for row in zip(*(columns[name].tolist() for name in names)):
+        ws.append([number_cell(value) if is_number else value for value, is_number in zip(row, numeric)])
+    wb.save(path)
+
+
+def write_csv(path, columns, column_types=COLUMNS):
+    # Header cells are "name:type" so a reader knows the column types without guessing; missing values are empty
+    text_columns = []
+    for name, kind in column_types:
+        values = columns[name]
+        if kind == "float64":
+            text_columns.append(["" if np.isnan(v) else repr(v) for v in values.tolist()])
+        else:
+            text_columns.append([str(v) for v in values.tolist()])
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow([f"{name}:{kind}" for name, kind in column_types])
+        writer.writerows(zip(*text_columns))
+
+
+def write_parquet(path, columns, column_types=COLUMNS):
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs the pyarrow package (pip install pyarrow)")
+    arrays = {}
+    for name, kind in column_types:
+        values = columns[name]
+        if kind == "string":
+            arrays[name] = pyarrow.array(values.tolist(), type=pyarrow.string())
+        elif kind == "int32":
+            arrays[name] = pyarrow.array(values.astype(np.int32))
+        else:
+            arrays[name] = pyarrow.array(values, from_pandas=True)    # NaN -> null
+    pyarrow.parquet.write_table(pyarrow.table(arrays), path)
+
+
+def write_columns(path, columns, column_types=COLUMNS):
+    # Pick the backend from the file extension; column_types lists the columns to write (COLUMNS or BATCH_COLUMNS)
+    extension = path.lower().rsplit(".", 1)[-1]
+    if extension == "csv":
+        write_csv(path, columns, column_types)
+    elif extension == "parquet":
+        write_parquet(path, columns, column_types)
+    else:
+        write_xlsx(path, columns, column_types=column_types)
@@ -0,0 +1,275 @@
+from collections.abc import MutableMapping
+import numpy as np
+import working_file
+import geometry
+
+
+# Measurements, bone lines and bone slopes of a study in one preallocated structured array, one fixed-size
+# record per frame. The viewer keeps using its dicts through the views below
+# (store.measurements / store.bone_lines / store.bone_slope), while exports and statistics read the arrays
+# directly.
+
+HAS_MEASUREMENTS = 1                        # frame has a measurements entry (possibly empty)
+HAS_h = 2
+HAS_H = 4
+HAS_RAW_CLICKS = 8
+HAS_BONE_LINE = 16
+HAS_BONE_SLOPE = 32
+
+MEASUREMENT_FLAGS = {"h": HAS_h, "H": HAS_H, "raw_clicks": HAS_RAW_CLICKS}
+
+STORE_DTYPE = np.dtype([
+    ("h", np.float64, (2, 2)),              # ((x1, y1), (x2, y2))
+    ("H", np.float64, (2, 2)),
+    ("raw_clicks", np.float64, (3, 2)),     # NaN for clicks not made (or None)
+    ("n_clicks", np.int8),                  # length of the raw_clicks tuple
+    ("bone_line", np.float64, (2, 2)),
+    ("bone_slope", np.float64),
+    ("valid", np.uint8),                    # HAS_* bits
+    ("revision", np.uint32),                # bumped on every change to the frame (see MeasurementStore.revision)
+])
+
+
+class MeasurementStore:
+    def __init__(self, num_frames=0):
+        self.records = np.zeros(num_frames, dtype=STORE_DTYPE)
+        self.generation = 0                     # bumped whenever all records are replaced
+        self.measurements = MeasurementsView(self)
+        self.bone_lines = BoneLinesView(self)
+        self.bone_slope = BoneSlopeView(self)
+
+    def reset(self, num_frames):
+        # Empty store sized for a newly loaded study
+        self.records = np.zeros(num_frames, dtype=STORE_DTYPE)
+        self.generation += 1
+
+    def ensure(self, frame):
+        # Grow (doubling) if a frame past the end is written
+        if frame >= len(self.records):
+            records = np.zeros(max(frame + 1, 2 * len(self.records), 16), dtype=STORE_DTYPE)
+            records[:len(self.records)] = self.records
+            self.records = records
+        return self.records[frame]
+
+    def revision(self, frame):
+        # Changes whenever the frame's measurements, bone line or slope change, for caches derived from them
+        count = int(self.records["revision"][frame]) if 0 <= frame < len(self.records) else 0
+        return self.generation, count
+
+    def touch(self, frames):
+        self.records["revision"][frames] += 1
+
+    def has(self, frame, flag):
+        return 0 <= frame < len(self.records) and bool(self.records["valid"][frame] & flag)
+
+    def frames_with(self, flag):
+        return np.flatnonzero(self.records["valid"] & flag)
+
+    def load(self, measurements, bone_lines, bone_slope, num_frames=0):
+        # Replace everything with the contents of plain dicts (as read from a working file or journal)
+        self.reset(num_frames)
+        for frame, frame_measures in measurements.items():
+            self.measurements[frame] = frame_measures
+        for frame, line in bone_lines.items():
+            self.bone_lines[frame] = line
+        for frame, slope in bone_slope.items():
+            self.bone_slope[frame] = slope
+
+    def copy(self):
+        # Independent snapshot (one array copy), e.g. for saving on another thread
+        store = MeasurementStore()
+        store.records = self.records.copy()
+        store.generation = self.generation
+        return store
+
+    def to_records(self):
+        # Measured frames as working_file.MEASUREMENT_DTYPE records, sorted by frame
+        frames = self.frames_with(HAS_MEASUREMENTS)
+        rows = self.records[frames]
+        records = np.zeros(len(frames), dtype=working_file.MEASUREMENT_DTYPE)
+        records["frame"] = frames
+        for key, flag in (("h", HAS_h), ("H", HAS_H)):
+            records[key] = np.where((rows["valid"] & flag)[:, None, None] > 0, rows[key], np.nan)
+        has_clicks = (rows["valid"] & HAS_RAW_CLICKS) > 0
+        records["raw_clicks"] = np.where(has_clicks[:, None, None], rows["raw_clicks"], np.nan)
+        records["n_clicks"] = np.where(has_clicks, rows["n_clicks"], -1)
+        return records
+
+    def lengths_mm(self, pixel_spacing):
+        # (frames, h in mm, H in mm) for every measured frame at once, NaN where h or H is missing
+        frames = self.frames_with(HAS_MEASUREMENTS)
+        rows = self.records[frames]
+        h = np.where(rows["valid"] & HAS_h, geometry.segment_lengths_mm(rows["h"], pixel_spacing), np.nan)
+        H = np.where(rows["valid"] & HAS_H, geometry.segment_lengths_mm(rows["H"], pixel_spacing), np.nan)
+        return frames, h, H
+
+
+def segment_tuple(row):
+    return ((float(row[0, 0]), float(row[0, 1])), (float(row[1, 0]), float(row[1, 1])))
+
+
+class FrameMeasuresView(MutableMapping):
+    # One frame's {'h': (p1, p2), 'H': (p1, p2), 'raw_clicks': (c1, c2[, c3])}, read and written in place
+    def __init__(self, store, frame):
+        self.store = store
+        self.frame = frame
+
+    def record(self):
+        return self.store.records[self.frame]
+
+    def __getitem__(self, key):
+        flag = MEASUREMENT_FLAGS.get(key)
+        if flag is None or not self.store.has(self.frame, flag):
+            raise KeyError(key)
+        record = self.record()
+        if key == "raw_clicks":
+            return tuple(working_file.point_from_row(p) for p in record["raw_clicks"][:record["n_clicks"]])
+        return segment_tuple(record[key])
+
+    def __setitem__(self, key, value):
+        flag = MEASUREMENT_FLAGS.get(key)
+        if flag is None:
+            raise KeyError(f"Unknown measurement: {key}")
+        record = self.store.ensure(self.frame)
+        if key == "raw_clicks":
+            clicks = list(value)[:3]
+            record["n_clicks"] = len(clicks)
+            record["raw_clicks"] = [working_file.point_or_nan(p) for p in clicks + [None] * (3 - len(clicks))]
+        else:
+            record[key] = [working_file.point_or_nan(p) for p in value]
+        record["valid"] |= HAS_MEASUREMENTS | flag
+        record["revision"] += 1
+
+    def __delitem__(self, key):
+        flag = MEASUREMENT_FLAGS.get(key)
+        if flag is None or not self.store.has(self.frame, flag):
+            raise KeyError(key)
+        self.record()["valid"] &= ~flag & 0xFF
+        self.store.touch(self.frame)
+
+    def __iter__(self):
+        valid = self.record()["valid"] if self.frame < len(self.store.records) else 0
+        return iter([key for key, flag in MEASUREMENT_FLAGS.items() if valid & flag])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MeasurementsView(MutableMapping):
+    # {frame: FrameMeasuresView} over the store
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, frame):
+        if not self.store.has(frame, HAS_MEASUREMENTS):
+            raise KeyError(frame)
+        return FrameMeasuresView(self.store, frame)
+
+    def __setitem__(self, frame, frame_measures):
+        frame_measures = dict(frame_measures)       # may be a view of this same frame
+        record = self.store.ensure(frame)
+        record["valid"] = (record["valid"] & (HAS_BONE_LINE | HAS_BONE_SLOPE)) | HAS_MEASUREMENTS
+        record["revision"] += 1
+        view = FrameMeasuresView(self.store, frame)
+        for key, value in frame_measures.items():
+            view[key] = value
+
+    def __delitem__(self, frame):
+        if not self.store.has(frame, HAS_MEASUREMENTS):
+            raise KeyError(frame)
+        self.store.records["valid"][frame] &= HAS_BONE_LINE | HAS_BONE_SLOPE
+        self.store.touch(frame)
+
+    def __contains__(self, frame):
+        return isinstance(frame, (int, np.integer)) and self.store.has(frame, HAS_MEASUREMENTS)
+
+    def __iter__(self):
+        return iter(self.store.frames_with(HAS_MEASUREMENTS).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store.records["valid"] & HAS_MEASUREMENTS))
+
+    def clear(self):
+        self.store.touch(self.store.frames_with(HAS_MEASUREMENTS))
+        self.store.records["valid"] &= HAS_BONE_LINE | HAS_BONE_SLOPE
+
+    def to_records(self):
+        return self.store.to_records()
+
+    def __repr__(self):
+        return repr({frame: dict(self[frame]) for frame in self})
+
+
+class BoneLinesView(MutableMapping):
+    # {frame: (p1, p2)}
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, frame):
+        if not self.store.has(frame, HAS_BONE_LINE):
+            raise KeyError(frame)
+        return segment_tuple(self.store.records["bone_line"][frame])
+
+    def __setitem__(self, frame, line):
+        record = self.store.ensure(frame)
+        record["bone_line"] = [working_file.point_or_nan(p) for p in line]
+        record["valid"] |= HAS_BONE_LINE
+        record["revision"] += 1
+
+    def __delitem__(self, frame):
+        if not self.store.has(frame, HAS_BONE_LINE):
+            raise KeyError(frame)
+        self.store.records["valid"][frame] &= ~HAS_BONE_LINE & 0xFF
+        self.store.touch(frame)
+
+    def __contains__(self, frame):
+        return isinstance(frame, (int, np.integer)) and self.store.has(frame, HAS_BONE_LINE)
+
+    def __iter__(self):
+        return iter(self.store.frames_with(HAS_BONE_LINE).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store.records["valid"] & HAS_BONE_LINE))
+
+    def clear(self):
+        self.store.touch(self.store.frames_with(HAS_BONE_LINE))
+        self.store.records["valid"] &= ~HAS_BONE_LINE & 0xFF
+
+
+class BoneSlopeView(MutableMapping):
+    # {frame: slope}
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, frame):
+        if not self.store.has(frame, HAS_BONE_SLOPE):
+            raise KeyError(frame)
+        return float(self.store.records["bone_slope"][frame])
+
+    def __setitem__(self, frame, slope):
+        record = self.store.ensure(frame)
+        record["bone_slope"] = float(slope)
+        record["valid"] |= HAS_BONE_SLOPE
+        record["revision"] += 1
+
+    def __delitem__(self, frame):
+        if not self.store.has(frame, HAS_BONE_SLOPE):
+            raise KeyError(frame)
+        self.store.records["valid"][frame] &= ~HAS_BONE_SLOPE & 0xFF
+        self.store.touch(frame)
+
+    def __contains__(self, frame):
+        return isinstance(frame, (int, np.integer)) and self.store.has(frame, HAS_BONE_SLOPE)
+
+    def __iter__(self):
+        return iter(self.store.frames_with(HAS_BONE_SLOPE).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store.records["valid"] & HAS_BONE_SLOPE))
+
+    def clear(self):
+        self.store.touch(self.store.frames_with(HAS_BONE_SLOPE))
+        self.store.records["valid"] &= ~HAS_BONE_SLOPE & 0xFF
@@ -0,0 +1,228 @@
+import argparse
+import glob
+import os
+import sys
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle
+import dicom_header_cache
+import geometry
+import reliability
+import working_file
+from batch_export import find_working_files, resolve_dicom_path, resolve_spacing
+
+
+# Comparison of any number of raters' working files. Each study's raters are aligned on (joint, frame)
+# into arrays, so every pairwise click difference is computed in one NumPy pass:
+#
+#   python rater_comparison.py FOLDER_OR_GLOB [...] -o differences.xlsx
+#
+# Working files are grouped by study (the DICOM they were measured on); only raters of the same study
+# are compared with each other.
+
+# Output order of the joints; unexpected joints follow alphabetically
+JOINT_ORDER = ["PD4", "PD3", "PD2", "PD5", "PM5", "PM4", "PM3", "PM2",
+               "PP5", "MC5", "PP4", "MC4", "PP3", "MC3", "PP2", "MC2", "PD1"]
+
+DIFFERENCE_COLUMNS = ["Click 1 dx (mm)", "Click 1 dy (mm)", "Click 2 dx (mm)", "Click 2 dy (mm)",
+                      "Click 3 dx (mm)", "Click 3 dy (mm)", "Click1 Dist (mm)", "Click2 Dist (mm)", "Click3 Dist (mm)"]
+
+
+def joint_rank(joint):
+    return (JOINT_ORDER.index(joint), "") if joint in JOINT_ORDER else (len(JOINT_ORDER), joint)
+
+
+def make_rater(name, study, pixel_spacing, measurement_records, label_records):
+    # One rater's working file as arrays (see working_file.MEASUREMENT_DTYPE / LABEL_DTYPE)
+    return {"name": name, "study": study, "pixel_spacing": pixel_spacing,
+            "measurements": measurement_records, "labels": label_records}
+
+
+def study_key(state_path, header, cache):
+    # Which study a working file was measured on: the SOPInstanceUID of its DICOM (from the header cache), else
+    # the DICOM's absolute path. Never the file name alone, different studies share names like IM0001.dcm.
+    dicom_path = resolve_dicom_path(state_path, header)
+    if dicom_path:
+        entry = cache.lookup(dicom_path)
+        if entry and entry.get("sop_instance_uid"):
+            return entry["sop_instance_uid"]
+        return dicom_header_cache.HeaderCache.key(dicom_path)
+    if header.get("sop_instance_uid"):
+        return header["sop_instance_uid"]
+    if header.get("dicom_path"):
+        return os.path.normcase(os.path.abspath(header["dicom_path"]))
+    return os.path.normcase(os.path.abspath(state_path))      # DICOM unknown: compared with nothing else
+
+
+def rater_from_state(name, state, pixel_spacing, study):
+    # From an already loaded state dict (as compare_measurements has); study as given by study_key
+    return make_rater(name, study, pixel_spacing,
+                      working_file.measurements_to_array(state.get("measurements", {})),
+                      working_file.labels_to_array(state.get("frame_joint_labels", {})))
+
+
+def load_rater(state_path, name, cache):
+    header = working_file.load_header(state_path)
+    pixel_spacing, dicom_filename, warning = resolve_spacing(state_path, header, cache)
+    rater = make_rater(name, study_key(state_path, header, cache), pixel_spacing,
+                       working_file.read_section(state_path, "measurements"),
+                       working_file.read_section(state_path, "labels"))
+    return rater, warning
+
+
+class RaterComparison:
+    # N raters of one study aligned on the union of their (joint, frame) labels:
+    #   present (N, K)         rater labelled that (joint, frame)
+    #   clicks  (N, K, 3, 2)   raw clicks in mm (x, y), NaN where missing
+    #   h, H    (N, K)         segment lengths in mm, NaN where missing
+    def __init__(self, study, raters):
+        self.study = study
+        self.names = [rater["name"] for rater in raters]
+        keys = set()
+        for rater in raters:
+            keys.update(zip(rater["labels"]["joint"].tolist(), rater["labels"]["frame"].tolist()))
+        self.keys = sorted(keys, key=lambda key: (joint_rank(key[0]), key[1]))
+        self.joints = np.array([joint for joint, _ in self.keys], dtype=object)
+        self.frames = np.array([frame for _, frame in self.keys], dtype=np.int64)
+        joint_order = {joint: rank for rank, joint in enumerate(dict.fromkeys(self.joints.tolist()))}
+        self.joint_ranks = np.array([joint_order[joint] for joint in self.joints], dtype=np.int64)
+        index = {key: k for k, key in enumerate(self.keys)}
+
+        n, k = len(raters), len(self.keys)
+        self.present = np.zeros((n, k), dtype=bool)
+        self.clicks = np.full((n, k, 3, 2), np.nan)
+        self.h = np.full((n, k), np.nan)
+        self.H = np.full((n, k), np.nan)
+
+        for r, rater in enumerate(raters):
+            labels, records = rater["labels"], rater["measurements"]
+            if len(labels) == 0:
+                continue
+            cols = np.array([index[key] for key in zip(labels["joint"].tolist(), labels["frame"].tolist())])
+            self.present[r, cols] = True
+            if len(records) == 0:
+                continue
+
+            # measurement record of each labelled frame (records are sorted by frame)
+            pos = np.minimum(np.searchsorted(records["frame"], labels["frame"]), len(records) - 1)
+            found = records["frame"][pos] == labels["frame"]
+            rows, cols = pos[found], cols[found]
+            row_spacing, col_spacing = rater["pixel_spacing"]
+            self.clicks[r, cols] = records["raw_clicks"][rows] * [col_spacing, row_spacing]
+            self.h[r, cols] = geometry.segment_lengths_mm(records["h"][rows], rater["pixel_spacing"])
+            self.H[r, cols] = geometry.segment_lengths_mm(records["H"][rows], rater["pixel_spacing"])
+
+    def pairwise(self):
+        # Every rater pair at once: (a, b) rater indices (P,), |dx|, |dy| (P, K, 3, 2) and distances (P, K, 3)
+        a, b = np.triu_indices(len(self.names), 1)
+        delta = np.abs(self.clicks[a] - self.clicks[b])
+        return a, b, delta, np.hypot(delta[..., 0], delta[..., 1])
+
+    def difference_rows(self):
+        # (rater a, rater b, joint, frame in a or None, frame in b or None, 9 differences or None) per pair and
+        # (joint, frame) labelled by either rater. Per joint: frames labelled by both, then only a, then only b.
+        a, b, delta, dist = self.pairwise()
+        values = np.concatenate([delta.reshape(len(a), len(self.keys), 6), dist], axis=2)
+        for p in range(len(a)):
+            in_a, in_b = self.present[a[p]], self.present[b[p]]
+            category = np.where(in_a & in_b, 0, np.where(in_a, 1, 2))
+            order = np.lexsort((np.arange(len(self.keys)), category, self.joint_ranks))
+            for k in order[(in_a | in_b)[order]]:
+                frame = int(self.frames[k])
+                yield (self.names[a[p]], self.names[b[p]], self.joints[k],
+                       frame if in_a[k] else None, frame if in_b[k] else None,
+                       [None if np.isnan(v) else float(v) for v in values[p, k]])
+
+
+def group_by_study(raters):
+    studies = {}
+    for rater in raters:
+        studies.setdefault(rater["study"], []).append(rater)
+    return studies
+
+
+def expand_inputs(inputs):
+    # Folders are searched recursively, anything else is treated as a glob pattern
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(find_working_files(item))
+        else:
+            paths.extend(sorted(glob.glob(item, recursive=True)))
+    return list(dict.fromkeys(os.path.abspath(path) for path in paths))
+
+
+def compare_files(paths, cache=None, log=print):
+    cache = cache or dicom_header_cache.HeaderCache()
+    # raters are named by their path below the folder all files share, so equal file names stay apart
+    common_folder = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else ""
+    raters = []
+    for path in paths:
+        name = os.path.splitext(os.path.relpath(os.path.abspath(path), common_folder))[0]
+        try:
+            rater, warning = load_rater(path, name, cache)
+        except Exception as e:
+            log(f"Skipping {path}: {e}")
+            continue
+        if warning:
+            log(f"{path}: {warning}")
+        raters.append(rater)
+    cache.save()
+
+    comparisons = []
+    for study, study_raters in group_by_study(raters).items():
+        if len(study_raters) < 2:
+            log(f"Only one working file for {study}, nothing to compare")
+            continue
+        comparisons.append(RaterComparison(study, study_raters))
+    return comparisons
+
+
+def write_workbook(path, comparisons):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Raw Click Differences")
+    ws.append(["Study", "Joint", "Rater A", "Rater B", "Rater A Frame", "Rater B Frame"] + DIFFERENCE_COLUMNS)
+
+    two_decimals = NamedStyle(name="two_decimals", number_format="0.00")
+    wb.add_named_style(two_decimals)
+
+    def number_cell(value):
+        if value is None:
+            return None
+        cell = WriteOnlyCell(ws, value=round(value, 2))
+        cell.style = two_decimals.name
+        return cell
+
+    for comparison in comparisons:
+        for name_a, name_b, joint, frame_a, frame_b, values in comparison.difference_rows():
+            ws.append([comparison.study, joint, name_a, name_b,
+                       frame_a + 1 if frame_a is not None else "", frame_b + 1 if frame_b is not None else ""]
+                      + [number_cell(value) for value in values])
+
+    reliability.write_sheets(wb, comparisons)
+    wb.save(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the clicks of every rater pair, per study.")
+    parser.add_argument("inputs", nargs="+", help="folders (searched recursively) or glob patterns of .dcmstate files")
+    parser.add_argument("-o", "--output", default="rater_differences.xlsx", help="output workbook")
+    args = parser.parse_args(argv)
+
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        parser.error("no .dcmstate files found")
+    try:
+        comparisons = compare_files(paths)
+        write_workbook(args.output, comparisons)
+    except Exception as e:
+        print(f"Failed to compare working files: {e}", file=sys.stderr)
+        return 1
+    print(f"Compared {sum(len(c.names) for c in comparisons)} working files in {len(comparisons)} studies, "
+          f"written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import numpy as np
+
+
+# Inter-/intra-rater reliability of h, H, OR and the raw clicks, computed from the aligned arrays of a
+# rater_comparison.RaterComparison. A "rater" is one working file, so two files of the same person on the
+# same study give intra-rater figures and files of different people give inter-rater figures.
+
+MAD_COLUMNS = ["MAD h (mm)", "MAD H (mm)", "MAD OR (%)",
+               "Click1 Mean Dist (mm)", "Click2 Mean Dist (mm)", "Click3 Mean Dist (mm)"]
+
+
+def measure_values(comparison):
+    # {measure: (raters, keys) array}, NaN where a rater has no value
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(comparison.H != 0, comparison.h / comparison.H * 100, np.nan)
+    return {"h": comparison.h, "H": comparison.H, "OR": ratio}
+
+
+def icc(values):
+    # ICC(1,1), ICC(2,1) and ICC(3,1) (Shrout & Fleiss) over the targets every rater measured.
+    # values: (raters, targets). Returns (n targets, icc1, icc2, icc3); NaN if there is too little data.
+    y = values[:, ~np.isnan(values).any(axis=0)].T          # (n targets, k raters)
+    n, k = y.shape
+    if n < 2 or k < 2:
+        return n, np.nan, np.nan, np.nan
+
+    grand_mean = y.mean()
+    ss_rows = k * ((y.mean(axis=1) - grand_mean) ** 2).sum()
+    ss_cols = n * ((y.mean(axis=0) - grand_mean) ** 2).sum()
+    ss_error = ((y - grand_mean) ** 2).sum() - ss_rows - ss_cols
+
+    ms_rows = ss_rows / (n - 1)
+    ms_cols = ss_cols / (k - 1)
+    ms_error = ss_error / ((n - 1) * (k - 1))
+    ms_within = (ss_cols + ss_error) / (n * (k - 1))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        icc1 = (ms_rows - ms_within) / (ms_rows + (k - 1) * ms_within)
+        icc2 = (ms_rows - ms_error) / (ms_rows + (k - 1) * ms_error + k * (ms_cols - ms_error) / n)
+        icc3 = (ms_rows - ms_error) / (ms_rows + (k - 1) * ms_error)
+    return n, icc1, icc2, icc3
+
+
+def bland_altman(values, a, b):
+    # Per rater pair (a[p], b[p]): (n, bias, SD of the differences, lower and upper 95% limits of agreement)
+    diffs = values[a] - values[b]                            # (pairs, keys)
+    valid = ~np.isnan(diffs)
+    n = valid.sum(axis=1)
+    d = np.where(valid, diffs, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bias = d.sum(axis=1) / n
+        sd = np.sqrt((np.where(valid, diffs - bias[:, None], 0.0) ** 2).sum(axis=1) / (n - 1))
+    sd = np.where(n > 1, sd, np.nan)
+    return n, bias, sd, bias - 1.96 * sd, bias + 1.96 * sd
+
+
+def grouped_mean(values, groups, n_groups):
+    # Mean of the non-NaN values per group along the last axis: (..., keys) -> (..., groups), plus the counts
+    valid = ~np.isnan(values)
+    sums = np.zeros(values.shape[:-1] + (n_groups,))
+    counts = np.zeros(values.shape[:-1] + (n_groups,))
+    np.add.at(sums, (..., groups), np.where(valid, values, 0.0))
+    np.add.at(counts, (..., groups), valid)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sums / counts, counts
+
+
+def joint_mean_absolute_differences(comparison):
+    # Per joint over all rater pairs: mean |difference| of h, H, OR and the mean distance of each click.
+    # Returns (joint names, counts (joints,), {column: (joints,) array}).
+    a, b, _, dist = comparison.pairwise()
+    joints = list(dict.fromkeys(comparison.joints.tolist()))
+    groups = comparison.joint_ranks
+    # all pairs stacked along the key axis, one row per h / H / OR / click distance
+    diffs = np.concatenate([np.abs(values[a] - values[b]) for values in measure_values(comparison).values()]
+                           + [dist[:, :, click] for click in range(3)]).reshape(len(MAD_COLUMNS), -1)
+    means, counts = grouped_mean(diffs, np.tile(groups, len(a)), len(joints))
+    return joints, counts.max(axis=0), dict(zip(MAD_COLUMNS, means))
+
+
+def number(value, digits=3):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def write_sheets(wb, comparisons):
+    # Add ICC, Bland-Altman and per-joint MAD sheets to wb (normal or write-only openpyxl workbook)
+    ws_icc = wb.create_sheet("ICC")
+    ws_icc.append(["Study", "Measure", "Raters", "Targets", "ICC(1,1)", "ICC(2,1)", "ICC(3,1)"])
+    ws_ba = wb.create_sheet("Bland-Altman")
+    ws_ba.append(["Study", "Measure", "Rater A", "Rater B", "N", "Bias (A - B)", "SD", "Lower LoA", "Upper LoA"])
+    ws_mad = wb.create_sheet("Per-joint MAD")
+    ws_mad.append(["Study", "Joint", "N"] + MAD_COLUMNS)
+
+    for comparison in comparisons:
+        a, b = np.triu_indices(len(comparison.names), 1)
+        for measure, values in measure_values(comparison).items():
+            n, icc1, icc2, icc3 = icc(values)
+            ws_icc.append([comparison.study, measure, len(comparison.names), n,
+                           number(icc1), number(icc2), number(icc3)])
+
+            counts, bias, sd, lower, upper = bland_altman(values, a, b)
+            for p in range(len(a)):
+                ws_ba.append([comparison.study, measure, comparison.names[a[p]], comparison.names[b[p]],
+                              int(counts[p]), number(bias[p]), number(sd[p]), number(lower[p]), number(upper[p])])
+
+        joints, counts, columns = joint_mean_absolute_differences(comparison)
+        for j, joint in enumerate(joints):
+            ws_mad.append([comparison.study, joint, int(counts[j])] + [number(columns[name][j]) for name in MAD_COLUMNS])
@@ -0,0 +1,17 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geometry
+
+
+def test_project_points_onto_degenerate_line_returns_line_start():
+    with np.errstate(all="raise"):
+        projected = geometry.project_points([(5.0, 7.0), (1.0, 2.0)], (3.0, 4.0), (3.0, 4.0))
+    assert np.array_equal(projected, [[3.0, 4.0], [3.0, 4.0]])
+
+
+def test_project_points_onto_line():
+    projected = geometry.project_points((2.0, 5.0), (0.0, 0.0), (10.0, 0.0))
+    assert np.allclose(projected, (2.0, 0.0))
@@ -0,0 +1,497 @@
+import glob
+import io
+import json
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import uuid
+import zipfile
+import numpy as np
+
+
+# .dcmstate working file format
+#
+# Version 2 files are zip archives with one member per section, so each section can be read on its own:
+#   header.json       DICOM identity (path, filename, SOPInstanceUID), pixel spacing and view state
+#   measurements.npy  one record per measured frame: h, H and raw clicks (NaN where missing)
+#   bone_lines.npy    one record per frame with a bone line: endpoints and slope
+#   labels.npy        one record per labelled frame: joint name
+# Arrays are stored with np.save and read back with allow_pickle=False, so loading never runs code.
+#
+# Version 1 files are the original pickled dicts; load_state still reads them (see read_legacy_pickle).
+
+FORMAT_NAME = "dcmstate"
+FORMAT_VERSION = 2
+SECTIONS = ("measurements", "bone_lines", "labels")
+
+MEASUREMENT_DTYPE = np.dtype([
+    ("frame", np.int32),
+    ("h", np.float64, (2, 2)),              # ((x1, y1), (x2, y2)), NaN if no h
+    ("H", np.float64, (2, 2)),              # ((x1, y1), (x2, y2)), NaN if no H
+    ("raw_clicks", np.float64, (3, 2)),     # up to 3 clicks, NaN for missing ones
+    ("n_clicks", np.int8),                  # -1 = no raw_clicks entry, else length of the raw_clicks tuple
+])
+BONE_LINE_DTYPE = np.dtype([
+    ("frame", np.int32),
+    ("line", np.float64, (2, 2)),           # ((x1, y1), (x2, y2)), NaN if only a slope was stored
+    ("slope", np.float64),                  # NaN if no slope was stored, inf for vertical lines
+])
+LABEL_DTYPE = np.dtype([
+    ("frame", np.int32),
+    ("joint", "U64"),                       # longer labels are refused (labels_to_array), never cut short
+])
+
+# Header keys copied straight from the state dict
+HEADER_KEYS = ("dicom_path", "dicom_filename", "sop_instance_uid", "pixel_spacing", "frame_index",
+               "zoom_level", "pan_offset", "window_center", "window_width",
+               "original_window_center", "original_window_width")
+
+
+def to_json_value(value):
+    # numpy scalars (eg. window levels computed from pixel data) are not JSON serialisable
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(v) for v in value]
+    return value
+
+
+def point_or_nan(p):
+    return (np.nan, np.nan) if p is None else (float(p[0]), float(p[1]))
+
+
+def point_from_row(row):
+    return None if np.isnan(row[0]) else (float(row[0]), float(row[1]))
+
+
+# SECTION <-> DICT CONVERSION
+def measurements_to_array(measurements):
+    if hasattr(measurements, "to_records"):
+        return measurements.to_records()        # already array-backed (measurement_store.MeasurementStore)
+    records = np.zeros(len(measurements), dtype=MEASUREMENT_DTYPE)
+    for i, frame in enumerate(sorted(measurements)):
+        frame_data = measurements[frame]
+        records[i]["frame"] = frame
+        records[i]["h"] = [point_or_nan(p) for p in frame_data.get("h", (None, None))]
+        records[i]["H"] = [point_or_nan(p) for p in frame_data.get("H", (None, None))]
+        clicks = frame_data.get("raw_clicks")
+        records[i]["n_clicks"] = -1 if clicks is None else len(clicks)
+        clicks = list(clicks or ()) + [None] * (3 - len(clicks or ()))
+        records[i]["raw_clicks"] = [point_or_nan(p) for p in clicks[:3]]
+    return records
+
+
+def measurements_from_array(records):
+    measurements = {}
+    for record in records:
+        frame_data = {}
+        for key in ("h", "H"):
+            if not np.isnan(record[key]).all():
+                frame_data[key] = (point_from_row(record[key][0]), point_from_row(record[key][1]))
+        if record["n_clicks"] >= 0:
+            frame_data["raw_clicks"] = tuple(point_from_row(p) for p in record["raw_clicks"][:record["n_clicks"]])
+        measurements[int(record["frame"])] = frame_data
+    return measurements
+
+
+def bone_lines_to_array(bone_lines, bone_slope):
+    frames = sorted(set(bone_lines) | set(bone_slope))
+    records = np.zeros(len(frames), dtype=BONE_LINE_DTYPE)
+    for i, frame in enumerate(frames):
+        records[i]["frame"] = frame
+        records[i]["line"] = [point_or_nan(p) for p in bone_lines.get(frame, (None, None))]
+        slope = bone_slope.get(frame)
+        records[i]["slope"] = np.nan if slope is None else float(slope)
+    return records
+
+
+def bone_lines_from_array(records):
+    bone_lines, bone_slope = {}, {}
+    for record in records:
+        frame = int(record["frame"])
+        if not np.isnan(record["line"]).all():
+            bone_lines[frame] = (point_from_row(record["line"][0]), point_from_row(record["line"][1]))
+        if not np.isnan(record["slope"]):
+            bone_slope[frame] = float(record["slope"])
+    return bone_lines, bone_slope
+
+
+def labels_to_array(labels):
+    records = np.zeros(len(labels), dtype=LABEL_DTYPE)
+    max_length = LABEL_DTYPE["joint"].itemsize // 4
+    for i, frame in enumerate(sorted(labels)):
+        if len(labels[frame]) > max_length:
+            raise ValueError(f"Joint label of frame {frame + 1} is longer than {max_length} characters: {labels[frame]!r}")
+        records[i] = (frame, labels[frame])
+    return records
+
+
+def labels_from_array(records):
+    return {int(record["frame"]): str(record["joint"]) for record in records}
+
+
+# WRITING
+def save_state(path, state):
+    # state uses the same keys as the viewer's working file dict (see DICOMViewer.working_state).
+    # The file is written to a temp file in the same folder, fsynced and renamed over path, so an
+    # interrupted save leaves either the old file or the new one, never a half-written one.
+    header = {"format": FORMAT_NAME, "version": FORMAT_VERSION}
+    header.update({key: to_json_value(state.get(key)) for key in HEADER_KEYS})
+
+    arrays = {
+        "measurements": measurements_to_array(state.get("measurements", {})),
+        "bone_lines": bone_lines_to_array(state.get("bone_lines", {}), state.get("bone_slope", {})),
+        "labels": labels_to_array(state.get("frame_joint_labels", {})),
+    }
+
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".dcmstate.tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_STORED) as zf:
+                zf.writestr("header.json", json.dumps(header, indent=1))
+                for name, records in arrays.items():
+                    buffer = io.BytesIO()
+                    np.save(buffer, records, allow_pickle=False)
+                    zf.writestr(f"{name}.npy", buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        copy_file_mode(temp_path, path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    fsync_folder(folder)
+
+
+def read_umask():
+    # os.umask can only be read by setting it, and the setting is process-wide. Done once at import (on the
+    # main thread), not on the save threads, where files created meanwhile would get the temporary value.
+    umask = os.umask(0o077)
+    os.umask(umask)
+    return umask
+
+
+PROCESS_UMASK = read_umask()
+
+
+def copy_file_mode(temp_path, path):
+    # mkstemp creates 0600 files and the rename keeps that mode; give the temp file the mode of the file
+    # it replaces, or the mode a plain open() would have given a new file
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~PROCESS_UMASK
+    os.chmod(temp_path, mode)
+
+
+def fsync_folder(folder):
+    # Make the rename itself durable (POSIX only, Windows has no directory handles to sync)
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    try:
+        fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def update_labels(path, labels):
+    # Replace only the joint labels of an existing working file
+    state = load_state(path)
+    state["frame_joint_labels"] = dict(labels)
+    save_state(path, state)
+
+
+# READING
+def is_legacy_file(path):
+    return not zipfile.is_zipfile(path)
+
+
+def load_header(path):
+    if is_legacy_file(path):
+        state = read_legacy_pickle(path)
+        return {key: state.get(key) for key in HEADER_KEYS}
+    with zipfile.ZipFile(path) as zf:
+        header = json.loads(zf.read("header.json"))
+    if header.get("format") != FORMAT_NAME or header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} is not a supported working file (version {header.get('version')})")
+    return header
+
+
+def read_section(path, name):
+    # Read one section's records without touching the others
+    if name not in SECTIONS:
+        raise ValueError(f"Unknown working file section: {name}")
+    if is_legacy_file(path):
+        state = read_legacy_pickle(path)
+        if name == "measurements":
+            return measurements_to_array(state.get("measurements", {}))
+        if name == "bone_lines":
+            return bone_lines_to_array(state.get("bone_lines", {}), state.get("bone_slope", {}))
+        return labels_to_array(state.get("frame_joint_labels", {}))
+    with zipfile.ZipFile(path) as zf:
+        with zf.open(f"{name}.npy") as f:
+            return np.load(io.BytesIO(f.read()), allow_pickle=False)
+
+
+def load_state(path, sections=SECTIONS):
+    # Returns the header values plus the requested sections, with the same keys and
+    # nested dict/tuple layout the viewer has always used
+    if is_legacy_file(path):
+        state = read_legacy_pickle(path)
+        wanted = {"measurements"} if "measurements" in sections else set()
+        wanted |= {"bone_lines", "bone_slope"} if "bone_lines" in sections else set()
+        wanted |= {"frame_joint_labels"} if "labels" in sections else set()
+        return {key: value for key, value in state.items() if key in HEADER_KEYS or key in wanted}
+
+    state = dict(load_header(path))
+    if "measurements" in sections:
+        state["measurements"] = measurements_from_array(read_section(path, "measurements"))
+    if "bone_lines" in sections:
+        state["bone_lines"], state["bone_slope"] = bone_lines_from_array(read_section(path, "bone_lines"))
+    if "labels" in sections:
+        state["frame_joint_labels"] = labels_from_array(read_section(path, "labels"))
+    return state
+
+
+# Migration: version 1 files are pickled dicts of plain Python values (plus numpy scalars for window levels).
+# Only those types are allowed to be rebuilt, anything else in the file is refused instead of executed.
+class LegacyUnpickler(pickle.Unpickler):
+    ALLOWED = {
+        ("numpy.core.multiarray", "scalar"),
+        ("numpy._core.multiarray", "scalar"),
+        ("numpy", "dtype"),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self.ALLOWED:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Working file contains a disallowed object: {module}.{name}")
+
+
+def read_legacy_pickle(path):
+    with open(path, "rb") as f:
+        state = LegacyUnpickler(f).load()
+    if not isinstance(state, dict):
+        raise ValueError(f"{path} is not a working file")
+    return state
+
+
+# JOURNAL (append-only autosave)
+#
+# Every edit is appended as one JSON line to <dicom name>.<session>.dcmjournal next to the DICOM, on a background
+# thread. Every compact_every records the journal is folded into <dicom name>.<session>.autosave.dcmstate and
+# truncated, so the cost of an edit never depends on how big the session is. After a crash the session is
+# recovered by loading the autosave file (if any) and replaying the journal on top of it.
+#
+# Each session (one DICOM or working file opened in one viewer) has its own pair of files, so two viewers on
+# the same DICOM never write to each other's journal. The first line of a journal names the working file the
+# session started from, and recovery is only offered to a session that starts from that same file.
+#
+# Record types:
+#   {"type": "session", "session": "3f2a...", "base": "/studies/a_rater1.dcmstate" or null}      (first line)
+#   {"type": "frame", "frame": 3, "measurements": {...} or null, "bone_line": [[x, y], [x, y]] or null, "bone_slope": 0.1 or null}
+#   {"type": "labels", "labels": {"3": "PD4", "4": null}}      (null removes a label)
+#   {"type": "clear_labels"}
+
+JOURNAL_SUFFIX = ".dcmjournal"
+AUTOSAVE_SUFFIX = ".autosave.dcmstate"
+
+
+def journal_paths(dicom_path, session_id):
+    base = f"{os.path.splitext(dicom_path)[0]}.{session_id}"
+    return base + JOURNAL_SUFFIX, base + AUTOSAVE_SUFFIX
+
+
+def session_base(working_file_path):
+    # What a journal is recorded against: the working file the session started from, None for a bare DICOM
+    return os.path.normcase(os.path.abspath(working_file_path)) if working_file_path else None
+
+
+def read_journal_header(journal_path):
+    with open(journal_path, "r", encoding="utf-8") as f:
+        try:
+            record = json.loads(f.readline())
+        except json.JSONDecodeError:
+            return None
+    return record if isinstance(record, dict) and record.get("type") == "session" else None
+
+
+def find_sessions(dicom_path, base_path=None):
+    # Session ids of the journals left next to dicom_path by sessions started from base_path, newest first
+    prefix = os.path.splitext(dicom_path)[0] + "."
+    sessions = []
+    for journal_path in glob.glob(glob.escape(prefix) + "*" + JOURNAL_SUFFIX):
+        session_id = journal_path[len(prefix):-len(JOURNAL_SUFFIX)]
+        if "." in session_id:
+            continue                            # journal of another DICOM whose name starts with this one's
+        header = read_journal_header(journal_path)
+        if header is not None and header.get("base") == session_base(base_path):
+            sessions.append((os.path.getmtime(journal_path), session_id))
+    return [session_id for _, session_id in sorted(sessions, reverse=True)]
+
+
+def remove_session(dicom_path, session_id):
+    for path in journal_paths(dicom_path, session_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def frame_record(frame, measurements, bone_lines, bone_slope):
+    return {
+        "type": "frame",
+        "frame": frame,
+        "measurements": dict(measurements[frame]) if frame in measurements else None,
+        "bone_line": bone_lines.get(frame),
+        "bone_slope": bone_slope.get(frame),
+    }
+
+
+def to_tuples(value):
+    # JSON turns the viewer's point tuples into lists, turn them back
+    if isinstance(value, list):
+        return tuple(to_tuples(v) for v in value)
+    if isinstance(value, dict):
+        return {k: to_tuples(v) for k, v in value.items()}
+    return value
+
+
+def apply_record(state, record):
+    if record["type"] == "frame":
+        frame = record["frame"]
+        for key, value in (("measurements", record["measurements"]), ("bone_lines", record["bone_line"]),
+                           ("bone_slope", record["bone_slope"])):
+            section = state.setdefault(key, {})
+            if value is None:
+                section.pop(frame, None)
+            else:
+                section[frame] = to_tuples(value)
+    elif record["type"] == "labels":
+        labels = state.setdefault("frame_joint_labels", {})
+        for frame, joint in record["labels"].items():
+            if joint is None:
+                labels.pop(int(frame), None)
+            else:
+                labels[int(frame)] = joint
+    elif record["type"] == "clear_labels":
+        state["frame_joint_labels"] = {}
+
+
+def replay_journal(state, journal_path):
+    # Apply every complete record; a torn last line (crash mid-write) is ignored
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            apply_record(state, record)
+    return state
+
+
+def recover_session(dicom_path, base_path=None, base_state=None):
+    # (session id, state) of the newest session left for this DICOM and working file, or None if there is
+    # nothing to recover. base_state is the working file's contents, the journal is replayed on top of it.
+    for session_id in find_sessions(dicom_path, base_path):
+        journal_path, autosave_path = journal_paths(dicom_path, session_id)
+        state = load_state(autosave_path) if os.path.exists(autosave_path) else dict(base_state or {})
+        replay_journal(state, journal_path)
+        return session_id, state
+    return None
+
+
+class SessionJournal:
+    def __init__(self, dicom_path, base_path=None, compact_every=200):
+        self.session_id = uuid.uuid4().hex
+        self.journal_path, self.autosave_path = journal_paths(dicom_path, self.session_id)
+        self.header = {"type": "session", "session": self.session_id, "base": session_base(base_path)}
+        self.compact_every = compact_every
+        self.records_since_compact = 0
+        self.total_records = 0                  # lets a caller tell whether edits happened since a snapshot
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, records, snapshot_func):
+        # records: list of journal records; snapshot_func() returns the full state dict for compaction.
+        # Called on the Tk thread, the writing itself happens on the journal thread.
+        for record in records:
+            self.queue.put(("record", json.dumps(record)))
+        self.records_since_compact += len(records)
+        self.total_records += len(records)
+        if self.records_since_compact >= self.compact_every:
+            self.records_since_compact = 0
+            self.queue.put(("compact", snapshot_func()))
+
+    def discard(self):
+        # The session was saved to a working file, nothing left to recover
+        self.records_since_compact = 0
+        self.queue.put(("discard", None))
+
+    def set_base(self, base_path):
+        # The session continues from a newly saved working file; recover onto that file from now on
+        self.queue.put(("base", session_base(base_path)))
+
+    def take_over(self, dicom_path, session_id, snapshot):
+        # Continue a recovered session: its state goes into this journal's autosave, then its files are removed
+        self.records_since_compact = 0
+        self.queue.put(("compact", snapshot))
+        self.queue.put(("remove", (dicom_path, session_id)))
+
+    def close(self):
+        self.queue.put(("close", None))
+        self.thread.join(timeout=5)
+
+    def run(self):
+        journal = None
+        while True:
+            kind, payload = self.queue.get()
+            try:
+                if kind == "record":
+                    if journal is None:
+                        journal = open(self.journal_path, "a", encoding="utf-8")
+                        if journal.tell() == 0:
+                            journal.write(json.dumps(self.header) + "\n")
+                    journal.write(payload + "\n")
+                    journal.flush()
+                elif kind == "compact":
+                    save_state(self.autosave_path, payload)
+                    if journal is not None:
+                        journal.close()
+                        journal = None
+                    with open(self.journal_path, "w", encoding="utf-8") as f:  # everything so far is in the autosave file
+                        f.write(json.dumps(self.header) + "\n")
+                elif kind == "base":
+                    self.header["base"] = payload
+                    if journal is not None:
+                        journal.close()
+                        journal = None
+                    if os.path.exists(self.journal_path):            # edits made meanwhile now belong to the new base
+                        with open(self.journal_path, "r", encoding="utf-8") as f:
+                            lines = f.readlines()[1:]
+                        with open(self.journal_path, "w", encoding="utf-8") as f:
+                            f.writelines([json.dumps(self.header) + "\n"] + lines)
+                elif kind == "remove":
+                    remove_session(*payload)
+                elif kind == "discard":
+                    if journal is not None:
+                        journal.close()
+                        journal = None
+                    for path in (self.journal_path, self.autosave_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+                elif kind == "close":
+                    if journal is not None:
+                        journal.close()
+                    return
+            except Exception as e:
+                print(f"Warning: autosave journal could not be written: {e}")